@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+"""Offline kstock benchmarks, run against a local fake quote server.
+
+The fake server answers Google- and Yahoo!-style quote requests with
+configurable latency, payload size and error rate, so results do not
+depend on the real services.
+"""
+__author__ = 'Kevin (penniesfromkevin at gmail)'
+__copyright__ = 'Copyright (c) 2014, Kevin.'
+__version__ = '0.1.0'
+
+import gc
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+
+from argparse import ArgumentParser
+
+try:
+    # py3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:
+    # py2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+
+try:
+    import tracemalloc
+except ImportError:
+    # py2; peak memory is not measured.
+    tracemalloc = None
+
+import kstock
+import sample_point_creator
+
+
+DEFAULT_SYMBOL_COUNTS = '10,100,1000,10000'
+DEFAULT_REPEAT = 5
+DEFAULT_LATENCY = 0.0 #seconds
+DEFAULT_PADDING = 0 #bytes per quote
+DEFAULT_ERROR_RATE = 0.0
+# Relative slowdown reported as a regression by --compare.
+DEFAULT_TOLERANCE = 0.2
+
+BENCHMARKS = ('get_all_google', 'get_all_yahoo', 'y_get_tags',
+        'conform_symbols', 'point_creator')
+
+LOG_LEVELS = ('CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG')
+DEFAULT_LOG_LEVEL = LOG_LEVELS[2]
+LOGGER = logging.getLogger()
+
+
+def parse_args():
+    """Parse user arguments and return as parser object.
+
+    Returns:
+        Parser object with arguments as attributes.
+    """
+    parser = ArgumentParser(description='Benchmark kstock offline.')
+    parser.add_argument('-n', '--symbols', default=DEFAULT_SYMBOL_COUNTS,
+            help='Comma-separated symbol counts to benchmark.')
+    parser.add_argument('-b', '--benchmarks', default=','.join(BENCHMARKS),
+            help='Comma-separated benchmarks to run; any of: %s.'
+                 % ', '.join(BENCHMARKS))
+    parser.add_argument('-r', '--repeat', default=DEFAULT_REPEAT, type=int,
+            help='Number of timed runs per benchmark and symbol count.')
+
+    parser.add_argument('-l', '--latency', default=DEFAULT_LATENCY,
+            type=float, help='Fake server response latency, in seconds.')
+    parser.add_argument('-p', '--padding', default=DEFAULT_PADDING,
+            type=int, help='Extra bytes per quote in fake responses.')
+    parser.add_argument('-e', '--error_rate', default=DEFAULT_ERROR_RATE,
+            type=float, help='Fraction of fake requests answered with 503.')
+
+    parser.add_argument('-o', '--output',
+            help='Save results to this JSON file.')
+    parser.add_argument('-c', '--compare',
+            help='Compare results with this earlier JSON file.')
+    parser.add_argument('-t', '--tolerance', default=DEFAULT_TOLERANCE,
+            type=float,
+            help='Relative p50 slowdown reported as a regression.')
+
+    parser.add_argument('-L', '--loglevel', choices=LOG_LEVELS,
+            default=DEFAULT_LOG_LEVEL, help='Set the logging level.')
+    args = parser.parse_args()
+    return args
+
+
+def fake_value(symbol, tag):
+    """Make up a stable, plausible quote value.
+
+    Args:
+        symbol: Stock symbol.
+        tag: Tag (Google or Yahoo!).
+
+    Returns:
+        Value string.
+    """
+    checksum = zlib.crc32(('%s %s' % (symbol, tag)).encode()) & 0xffffffff
+    return '%.2f' % (checksum % 100000 / 100.0)
+
+
+class FakeQuoteHandler(BaseHTTPRequestHandler):
+    """Answer Google (JSON) and Yahoo! (CSV) quote requests."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if random.random() < server.error_rate:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        query = parse_qs(urlsplit(self.path).query)
+        if 'q' in query:
+            body = self.google_body(query['q'][0].split(','))
+        else:
+            body = self.yahoo_body(query['s'][0].split(),
+                    re.findall('[a-z][0-9]?', query['f'][0]))
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def google_body(self, symbols):
+        """Build a Google-style '//'-prefixed JSON response.
+        """
+        quotes = []
+        for symbol in symbols:
+            quote = dict((tag, fake_value(symbol, tag))
+                    for tag in kstock.G_TAGS.values())
+            quote['t'] = symbol.split(':')[-1]
+            if self.server.padding:
+                quote['pad'] = 'x' * self.server.padding
+            quotes.append(quote)
+        return '// %s' % json.dumps(quotes)
+
+    def yahoo_body(self, symbols, tags):
+        """Build a Yahoo!-style CSV response.
+        """
+        padding = 'x' * self.server.padding
+        rows = []
+        for symbol in symbols:
+            row = ','.join(fake_value(symbol, tag) for tag in tags)
+            if padding:
+                row = '%s,"%s"' % (row, padding)
+            rows.append(row)
+        return '\r\n'.join(rows)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeQuoteServer(ThreadingMixIn, HTTPServer):
+    """Local stand-in for the Google and Yahoo! quote services.
+
+    Call start() to serve from a background thread; G_QUOTE_URL and
+    Y_QUOTE_URL give the URLs to point kstock at.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=DEFAULT_LATENCY, padding=DEFAULT_PADDING,
+            error_rate=DEFAULT_ERROR_RATE):
+        """Bind to a free localhost port.
+
+        Args:
+            latency: Seconds to wait before answering each request.
+            padding: Extra bytes added to each quote.
+            error_rate: Fraction of requests answered with HTTP 503.
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeQuoteHandler)
+        self.latency = latency
+        self.padding = padding
+        self.error_rate = error_rate
+        base_url = 'http://127.0.0.1:%d' % self.server_port
+        self.G_QUOTE_URL = '%s/finance/info' % base_url
+        self.Y_QUOTE_URL = '%s/d/quotes.csv' % base_url
+
+    def start(self):
+        """Serve requests from a daemon thread.
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """Stop serving and close the socket.
+        """
+        self.shutdown()
+        self.server_close()
+
+
+def make_symbols(count):
+    """Make up a list of distinct symbols.
+
+    Args:
+        count: Number of symbols.
+
+    Returns:
+        List of symbols, some with exchange prefix or index marker.
+    """
+    symbols = []
+    for index in range(count):
+        symbol = 'S%05d' % index
+        if index % 10 == 1:
+            symbol = 'NASDAQ:%s' % symbol
+        elif index % 10 == 2:
+            symbol = '^%s' % symbol
+        symbols.append(symbol)
+    return symbols
+
+
+def percentile(values, percent):
+    """Get a percentile of a list of numbers (nearest rank).
+
+    Args:
+        values: List of numbers.
+        percent: Percentile, 0 to 100.
+
+    Returns:
+        Value at the percentile.
+    """
+    values = sorted(values)
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def point_creator_symbols(symbols):
+    """Build the per-API symbol dictionary the point creator polls.
+
+    Args:
+        symbols: List of symbols.
+
+    Returns:
+        Dictionary like sample_point_creator.get_symbols() returns.
+    """
+    api_symbols = {}
+    for api in kstock.APIS:
+        api_symbols[api] = kstock.conform_symbols(symbols, api)
+        params = sample_point_creator.DEFAULT_PARAMS[api]
+        api_symbols['%s_params' % api] = params.split(',')
+    return api_symbols
+
+
+def make_benchmark(name, symbols):
+    """Get the function to time for a benchmark.
+
+    Args:
+        name: Benchmark name; see BENCHMARKS.
+        symbols: List of symbols.
+
+    Returns:
+        Function without arguments.
+    """
+    if name == 'get_all_google':
+        return lambda: kstock.get_all(symbols, 'google')
+    if name == 'get_all_yahoo':
+        return lambda: kstock.get_all(symbols, 'yahoo')
+    if name == 'y_get_tags':
+        tags = ['last_trade_price', 'previous_close', 'volume']
+        return lambda: kstock._y_get_tags(symbols, tags)
+    if name == 'conform_symbols':
+        return lambda: (kstock.conform_symbols(symbols, 'google'),
+                kstock.conform_symbols(symbols, 'yahoo'))
+    if name == 'point_creator':
+        api_symbols = point_creator_symbols(symbols)
+        return lambda: [sample_point_creator.poll_api(api_symbols, api)
+                for api in kstock.APIS]
+    raise ValueError('Unknown benchmark: %s' % name)
+
+
+def run_benchmark(name, count, repeat):
+    """Time one benchmark for one symbol count.
+
+    Args:
+        name: Benchmark name; see BENCHMARKS.
+        count: Number of symbols.
+        repeat: Number of timed runs.
+
+    Returns:
+        Dictionary of results.
+    """
+    function = make_benchmark(name, make_symbols(count))
+    function()  # warm up connections and caches
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+    latencies = []
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        latencies.append(time.time() - start)
+    if tracemalloc:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        peak_memory = None
+    result = {
+            'benchmark': name,
+            'symbols': count,
+            'repeat': repeat,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'symbols_per_second': count * repeat / max(sum(latencies),
+                    1e-9),
+            'peak_memory': peak_memory,
+            }
+    return result
+
+
+def format_result(result):
+    """Format a result dictionary as a report line.
+    """
+    if result['peak_memory'] is None:
+        memory = 'n/a'
+    else:
+        memory = '%.1f MiB' % (result['peak_memory'] / 1048576.0)
+    return ('%-16s %6d symbols  p50 %8.2f ms  p99 %8.2f ms  '
+            '%10.0f symbols/s  peak %s' % (result['benchmark'],
+            result['symbols'], result['p50'] * 1000, result['p99'] * 1000,
+            result['symbols_per_second'], memory))
+
+
+def compare_results(results, baseline, tolerance):
+    """Report p50 changes against earlier results.
+
+    Args:
+        results: List of result dictionaries.
+        baseline: List of earlier result dictionaries.
+        tolerance: Relative slowdown reported as a regression.
+
+    Returns:
+        Number of regressions.
+    """
+    earlier = dict(((result['benchmark'], result['symbols']), result)
+            for result in baseline)
+    regressions = 0
+    for result in results:
+        old = earlier.get((result['benchmark'], result['symbols']))
+        if old is None or not old['p50']:
+            continue
+        change = result['p50'] / old['p50'] - 1
+        status = 'ok'
+        if change > tolerance:
+            status = 'REGRESSION'
+            regressions += 1
+        LOGGER.warning('%-16s %6d symbols  p50 %+6.1f%%  %s',
+                result['benchmark'], result['symbols'], change * 100,
+                status)
+    return regressions
+
+
+def main():
+    """Main script.
+    """
+    server = FakeQuoteServer(ARGS.latency, ARGS.padding, ARGS.error_rate)
+    server.start()
+    kstock.G_QUOTE_URL = server.G_QUOTE_URL
+    kstock.Y_QUOTE_URL = server.Y_QUOTE_URL
+    kstock.POOL = kstock.ConnectionPool()
+    kstock.QUOTE_CACHE = None
+    # Measure kstock itself, not the request rate limit.
+    for api in kstock.APIS:
+        kstock.PROVIDERS[api] = kstock.ProviderGuard(
+                kstock.RateLimiter(rate=1e6, burst=1e6))
+    results = []
+    try:
+        for name in ARGS.benchmarks.split(','):
+            for count in ARGS.symbols.split(','):
+                result = run_benchmark(name.strip(), int(count), ARGS.repeat)
+                LOGGER.warning(format_result(result))
+                results.append(result)
+    finally:
+        server.stop()
+        kstock.POOL.clear()
+    if ARGS.output:
+        with open(ARGS.output, 'w') as file_handle:
+            json.dump(results, file_handle, indent=2, sort_keys=True)
+    regressions = 0
+    if ARGS.compare:
+        with open(ARGS.compare, 'r') as file_handle:
+            baseline = json.load(file_handle)
+        regressions = compare_results(results, baseline, ARGS.tolerance)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    logging.basicConfig(format='%(message)s',
+                        level=getattr(logging, ARGS.loglevel))
+    sys.exit(main())
@@ -7,21 +7,94 @@ __copyright__ = 'Copyright (c) 2014, Kevin'
 __version__ = '0.1.0'
 __license__ = 'MIT license'
 
+import codecs
 import csv
 import json
 import logging
+import re
+import socket
+import threading
+import time
+import zlib
+
+from collections import OrderedDict, namedtuple
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+try:
+    import numpy
+except ImportError:
+    # Optional; only needed for columnar results (QuoteTable).
+    numpy = None
 
 try:
     # py3
-    from urllib.request import Request, urlopen
-    from urllib.error import HTTPError
+    from collections.abc import MutableMapping
+    from http.client import HTTPConnection, HTTPException, HTTPSConnection
+    from queue import Empty, Queue
+    from urllib.parse import urljoin, urlsplit
 except ImportError:
     # py2
-    from urllib2 import Request, urlopen, HTTPError
+    from collections import MutableMapping
+    from httplib import HTTPConnection, HTTPException, HTTPSConnection
+    from Queue import Empty, Queue
+    from urlparse import urljoin, urlsplit
 
 APIS = ('google', 'yahoo')
 DEFAULT_API = APIS[0]
 
+# Maximum number of symbols sent in a single request, per API.
+BATCH_SIZES = {
+    'google': 100,
+    'yahoo': 200,
+    }
+# Maximum number of batches fetched concurrently by get_all().
+DEFAULT_MAX_WORKERS = 4
+# Errors that cause a single batch to be dropped rather than the whole
+# get_all() call to fail.
+BATCH_ERRORS = (IOError, OSError, KeyError, IndexError, ValueError)
+
+# Idle keep-alive connections kept per host, and socket timeout.
+DEFAULT_POOL_SIZE = 4
+DEFAULT_TIMEOUT = 10  # seconds
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+# Outbound request limits per API; see RateLimiter and CircuitBreaker.
+DEFAULT_RATE = 10.0  # requests per second
+DEFAULT_BURST = 10
+DEFAULT_MIN_RATE = 0.1  # requests per second
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30  # seconds
+THROTTLE_CODES = (429,)
+# Bytes read at a time by streaming requests.
+STREAM_CHUNK_SIZE = 16384
+
+# Quote cache defaults; see QuoteCache.
+DEFAULT_CACHE_TTL = 5  # seconds
+DEFAULT_CACHE_ENTRIES = 100000
+# Cache tag used for whole-quote entries (Google returns all tags).
+ALL_TAGS = '*'
+
+# Number parsing; see parse_number().
+MISSING_VALUES = ('', '-', 'N/A')
+NUMBER_SUFFIXES = {
+    'K': 1e3,
+    'M': 1e6,
+    'B': 1e9,
+    'T': 1e12,
+    }
+# Tags stored as int64 in a QuoteTable when no values are missing.
+INTEGER_TAGS = frozenset([
+    'ask_size',
+    'average_daily_volume',
+    'bid_size',
+    'float_shares',
+    'last_trade_size',
+    'shares_outstanding',
+    'shares_owned',
+    'volume',
+    ])
+
 G_QUOTE_URL = 'http://finance.google.com/finance/info'
 G_TAGS = {
     'change': 'c',  # '-7.86'
@@ -139,250 +212,2002 @@ Y_TAGS = {
     'volume': 'v',
     }
 
-LOGGER = logging.getLogger()
 
+def _reverse_tags(tags):
+    """Build a tag to tag name dictionary.
 
-def _request(url):
-    """Makes the URL info request.
+    Some tags have more than one name (e.g., Yahoo! 'v'); the first
+    name in alphabetical order wins.
 
     Args:
-        url: URL that returns data.
+        tags: Tag name to tag dictionary; G_TAGS or Y_TAGS.
 
     Returns:
-        Response string.
+        Tag to tag name dictionary.
     """
-    LOGGER.debug('_request URL: %s', url)
-    try:
-        request = Request(url)
-        response = urlopen(request)
-        content = response.read().decode().strip()
-    except HTTPError as err:
-        LOGGER.error('_request: HTTPError %s: %s', err.code, err.reason)
-        content = ''
-    LOGGER.debug('_request content: %s', content)
-    return content
+    tag_names = {}
+    for tag_name, tag in sorted(tags.items()):
+        tag_names.setdefault(tag, tag_name)
+    return tag_names
 
 
-def _request_y_symbols(symbols, tag_string):
-    """Makes the Yahoo! Finance info request.
+# Tag names both APIs provide; see get_quotes().
+COMMON_TAGS = tuple(sorted(set(G_TAGS) & set(Y_TAGS)))
+
+# Tag registry, built once at import; do not modify.
+G_TAG_NAMES = _reverse_tags(G_TAGS)
+Y_TAG_NAMES = _reverse_tags(Y_TAGS)
+Y_ALL_TAG_NAMES = tuple(sorted(Y_TAGS))
+_Y_TAG_PLANS = {}
+_Y_LAYOUTS = {}
+_G_LAYOUTS = {}
+
+Y_TAG_PATTERN = re.compile('[a-z][0-9]?')
+# Upper bound on the number of cached Yahoo! tag plans; see _y_tag_plan().
+MAX_TAG_PLANS = 256
+# Upper bound on the number of cached symbol forms; see symbol_forms().
+MAX_SYMBOL_FORMS = 100000
+_SYMBOL_FORMS = {}
+
+LOGGER = logging.getLogger()
+
+# Instrumentation hooks; see add_hook().
+_HOOKS = []
+
+
+def add_hook(hook):
+    """Register an instrumentation hook.
+
+    Hooks are called as hook(kind, name, value) for:
+        ('timing', stage, seconds), where stage is 'request' (network),
+            'parse' (JSON/CSV decoding) or 'transform' (re-mapping into
+            result dictionaries);
+        ('count', 'bytes_received', bytes);
+        ('count', 'symbols_per_request', symbols);
+        ('count', 'errors', 1).
+    With no hooks registered, instrumentation costs next to nothing.
 
     Args:
-        symbols: Stock symbol or, confusingly, list of stock symbols.
-        tag_string: Tag or, confusingly, tag combination.
-            Examples:
-                'p1'   # single tag
-                'np1v' # tag combination
+        hook: Function taking (kind, name, value) arguments; e.g., a
+            StatsCollector instance.
+    """
+    _HOOKS.append(hook)
 
-    Returns:
-        Dictionary with symbols as keys and list of tag values as
-        values.
-        {
-            symbol1: [value1, .., valueN],
-            ..
-            symbolM: [value1, .., valueN],
-            }
+
+def remove_hook(hook):
+    """Unregister an instrumentation hook.
+
+    Args:
+        hook: Hook passed to add_hook().
     """
-    if isinstance(symbols, str):
-        symbols = [symbols]
-    symbols = conform_symbols(symbols, 'yahoo')
-    symbol_string = '+'.join(symbols)
-    url = '%s?s=%s&f=%s' % (Y_QUOTE_URL, symbol_string, tag_string)
-    content = _request(url)
-    csv_reader = csv.reader(content.splitlines(), delimiter=',')
-    content = [row for row in csv_reader]
-    return_dict = {}
-    if content:
-        for index, symbol in enumerate(symbols):
-            return_dict[symbol] = content[index]
-    return return_dict
+    _HOOKS.remove(hook)
 
 
-def _y_get_all(symbols):
-    """Get all Yahoo! quote data for the given ticker symbols.
+def _count(name, value=1):
+    """Report a counter to the instrumentation hooks.
 
     Args:
-        symbols: Stock symbol or, confusingly, list of stock symbols.
+        name: Counter name; see add_hook().
+        value: Amount to add.
+    """
+    for hook in _HOOKS:
+        hook('count', name, value)
 
-    Returns:
-        Dictionary of symbols with dictionary of tag values requested.
-        See _y_get_tags().
+
+class _Stage(object):
+    """Context manager reporting the duration of a stage to the hooks.
     """
-    tags = Y_TAGS.keys()
-    symbol_data = _y_get_tags(symbols, tags)
-    return symbol_data
 
+    __slots__ = ('name', 'start')
 
-def _y_get_tag(symbols, tag_string):
-    """Get Yahoo! tag values for multiple symbols.
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if _HOOKS:
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            seconds = time.time() - self.start
+            for hook in _HOOKS:
+                hook('timing', self.name, seconds)
+
+
+class StatsCollector(object):
+    """Instrumentation hook that aggregates counters and stage timings.
+
+    Register with add_hook(); read with stats(), log() or
+    graphite_lines().
+    """
+
+    def __init__(self):
+        """Set up with empty statistics.
+        """
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __call__(self, kind, name, value):
+        with self._lock:
+            if kind == 'timing':
+                calls, total, longest = self._timings.get(name, (0, 0.0, 0.0))
+                self._timings[name] = (calls + 1, total + value,
+                                       max(longest, value))
+            else:
+                self._counts[name] = self._counts.get(name, 0) + value
+
+    def reset(self):
+        """Clear all statistics.
+        """
+        with self._lock:
+            self._counts = {}
+            self._timings = {}
+
+    def stats(self):
+        """Get the statistics gathered so far.
+
+        Returns:
+            Dictionary of metric name to value; e.g.,
+            {'request.calls': 2, 'request.seconds': 0.31,
+             'request.max_seconds': 0.2, 'bytes_received': 5120}
+        """
+        with self._lock:
+            stats = dict(self._counts)
+            for name, (calls, total, longest) in self._timings.items():
+                stats['%s.calls' % name] = calls
+                stats['%s.seconds' % name] = total
+                stats['%s.max_seconds' % name] = longest
+        return stats
+
+    def log(self, level=logging.INFO):
+        """Log the statistics gathered so far.
+
+        Args:
+            level: Logging level.
+        """
+        for name, value in sorted(self.stats().items()):
+            LOGGER.log(level, 'kstock %s: %s', name, value)
+
+    def graphite_lines(self, host, prefix='kstock'):
+        """Format the statistics as metric lines.
+
+        Lines use the same format as sample_point_creator.py.
+
+        Args:
+            host: Host name reported with each metric.
+            prefix: Metric name prefix.
+
+        Returns:
+            List of metric lines.
+        """
+        lines = []
+        for name, value in sorted(self.stats().items()):
+            if isinstance(value, float):
+                value = '%.6f' % value
+            lines.append("%s.%s %s host='%s'" % (prefix, name, value, host))
+        return lines
+
+
+class ConnectionPool(object):
+    """Pool of keep-alive HTTP connections, reused per host.
+
+    Connections are checked out for the duration of a single request,
+    so the pool may be shared between threads.  At most maxsize idle
+    connections are kept per host; extra connections are closed when
+    they are returned.
+    """
+
+    def __init__(self, maxsize=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        """Set up an empty pool.
+
+        Args:
+            maxsize: Maximum number of idle connections kept per host.
+            timeout: Socket timeout for new connections, in seconds.
+        """
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        """Check out an idle connection, or create a new one.
+
+        Args:
+            key: (scheme, host, port) tuple.
+
+        Returns:
+            (connection, reused) tuple.
+        """
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port = key
+        if scheme == 'https':
+            connection_class = HTTPSConnection
+        else:
+            connection_class = HTTPConnection
+        return connection_class(host, port, timeout=self.timeout), False
+
+    def _put(self, key, connection):
+        """Return a connection to the pool, or close it if it is full.
+
+        Args:
+            key: (scheme, host, port) tuple.
+            connection: Connection with no outstanding response.
+        """
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        """Close all idle connections.
+        """
+        with self._lock:
+            idle_lists = list(self._idle.values())
+            self._idle = {}
+        for idle in idle_lists:
+            for connection in idle:
+                connection.close()
+
+    def _open(self, url):
+        """Send a GET request, retrying once on a stale connection.
+
+        Args:
+            url: URL to request.
+
+        Returns:
+            (key, connection, response) tuple; the response body has not
+            been read yet.  Pass the tuple to _release() once it has.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        headers = {'Accept-Encoding': 'gzip'}
+        while True:
+            connection, reused = self._get(key)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except (HTTPException, socket.error):
+                connection.close()
+                if reused:
+                    # The server closed an idle connection; try again
+                    # on a fresh one.
+                    continue
+                raise
+            return key, connection, response
+
+    def _release(self, key, connection, response):
+        """Return a connection whose response has been read in full.
+
+        Args:
+            key: (scheme, host, port) tuple.
+            connection: Connection the response was read from.
+            response: Fully read response.
+        """
+        if response.will_close:
+            connection.close()
+        else:
+            self._put(key, connection)
+
+    def _open_following(self, url):
+        """Open a GET request, following redirects.
+
+        Args:
+            url: URL to request.
+
+        Returns:
+            (key, connection, response) tuple; see _open().
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            key, connection, response = self._open(url)
+            location = response.getheader('location')
+            if response.status not in REDIRECT_CODES or not location:
+                break
+            self._read(key, connection, response)
+            url = urljoin(url, location)
+        return key, connection, response
+
+    def _read(self, key, connection, response):
+        """Read a whole response body and release its connection.
+
+        Args:
+            key: (scheme, host, port) tuple.
+            connection: Connection the response is read from.
+            response: Response with an unread body.
+
+        Returns:
+            Raw (possibly compressed) response body.
+        """
+        try:
+            body = response.read()
+        except (HTTPException, socket.error):
+            connection.close()
+            raise
+        self._release(key, connection, response)
+        return body
+
+    def request(self, url):
+        """Make a GET request, following redirects.
+
+        Args:
+            url: URL to request.
+
+        Returns:
+            (status, reason, body) tuple; body is decompressed bytes.
+        """
+        key, connection, response = self._open_following(url)
+        body = self._read(key, connection, response)
+        if response.getheader('content-encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return response.status, response.reason, body
+
+    def _iter_body(self, key, connection, response, chunk_size):
+        """Generate decompressed body chunks, then release the connection.
+
+        If the generator is closed before the body has been read in
+        full, the connection is closed rather than reused.
+
+        Args:
+            key: (scheme, host, port) tuple.
+            connection: Connection the response is read from.
+            response: Response with an unread body.
+            chunk_size: Number of bytes read at a time.
+
+        Yields:
+            Chunks of the decompressed response body (bytes).
+        """
+        if response.getheader('content-encoding') == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            decompressor = None
+        done = False
+        try:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                if decompressor:
+                    chunk = decompressor.decompress(chunk)
+                if chunk:
+                    yield chunk
+            if decompressor:
+                chunk = decompressor.flush()
+                if chunk:
+                    yield chunk
+            done = True
+        finally:
+            if done:
+                self._release(key, connection, response)
+            else:
+                connection.close()
+
+    def stream(self, url, chunk_size=STREAM_CHUNK_SIZE):
+        """Make a GET request, following redirects, without reading it.
+
+        Args:
+            url: URL to request.
+            chunk_size: Number of bytes read at a time.
+
+        Returns:
+            (status, reason, chunks) tuple; chunks is a generator of
+            decompressed body chunks (bytes).
+        """
+        key, connection, response = self._open_following(url)
+        chunks = self._iter_body(key, connection, response, chunk_size)
+        return response.status, response.reason, chunks
+
+
+POOL = ConnectionPool()
+
+
+class RateLimiter(object):
+    """Token bucket rate limiter that adapts to throttling.
+
+    Each request takes a token; tokens refill at `rate` per second, up
+    to `burst`.  When the server throttles (HTTP 429 or 5xx), the rate
+    is halved, down to min_rate; each success raises it again by a
+    twentieth of max_rate.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                 min_rate=DEFAULT_MIN_RATE):
+        """Set up a full bucket.
+
+        Args:
+            rate: Maximum (and initial) requests per second.
+            burst: Bucket size; requests allowed at once.
+            min_rate: Lowest rate throttling can lead to.
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for one if the bucket is empty.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                elapsed = now - self._updated
+                self._tokens = min(self.burst,
+                                   self._tokens + elapsed * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        """Slow down after the server throttled a request.
+        """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        """Speed up again after a successful request.
+        """
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class CircuitBreaker(object):
+    """Stop sending requests to a failing server for a while.
+
+    States:
+        closed: requests go through; failure_threshold consecutive
+            failures open the circuit.
+        open: requests are rejected until reset_timeout seconds have
+            passed, then the circuit is half-open.
+        half_open: a single trial request goes through; success closes
+            the circuit, failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    STATES = (CLOSED, HALF_OPEN, OPEN)
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT):
+        """Set up a closed circuit.
+
+        Args:
+            failure_threshold: Consecutive failures that open it.
+            reset_timeout: Seconds it stays open.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opens = 0
+        self.rejected = 0
+        self._state = self.CLOSED
+        self._opened = 0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """Current state; an open circuit turns half-open after the
+        reset timeout.
+        """
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if (self._state == self.OPEN and
+                time.time() - self._opened >= self.reset_timeout):
+            self._state = self.HALF_OPEN
+            self._trial = False
+        return self._state
+
+    def allow(self):
+        """Check whether a request may go through.
+
+        Returns:
+            True if the request may be sent.
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        """Record a successful request.
+        """
+        with self._lock:
+            self._state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        """Record a failed request.
+        """
+        with self._lock:
+            self.failures += 1
+            if (self._state == self.HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                if self._state != self.OPEN:
+                    self.opens += 1
+                self._state = self.OPEN
+                self._opened = time.time()
+
+
+class ProviderGuard(object):
+    """Rate limiter and circuit breaker for one API.
+
+    Attributes:
+        limiter: RateLimiter instance.
+        breaker: CircuitBreaker instance.
+    """
+
+    def __init__(self, limiter=None, breaker=None):
+        self.limiter = limiter or RateLimiter()
+        self.breaker = breaker or CircuitBreaker()
+
+
+# ProviderGuard per API (or host, for other URLs); created on first use.
+# Assign an instance to change the limits for an API.
+PROVIDERS = {}
+_PROVIDERS_LOCK = threading.Lock()
+
+
+def _url_provider(url):
+    """Get the provider name for a URL.
 
     Args:
-        symbols: Stock symbol or, confusingly, list of stock symbols.
-        tag_string: Tag name, tag, or, confusingly, tag combination.
-        Examples:
-            'trade_date' # tag name
-            'd2'         # tag
-            'nd1d2'      # tag combination
+        url: Request URL.
 
     Returns:
-        Dictionary of symbols with list of tag values requested.
-        {
-            symbol1: [value1, .., valueN],
-            ..
-            symbolN: [value1, .., valueN],
-            }
+        'google' or 'yahoo' for quote URLs, otherwise the host name.
     """
-    if tag_string in Y_TAGS:
-        tag_string = Y_TAGS[tag_string]
-    return_dict = _request_y_symbols(symbols, tag_string)
-    return return_dict
+    if url.startswith(G_QUOTE_URL):
+        return 'google'
+    if url.startswith(Y_QUOTE_URL):
+        return 'yahoo'
+    return urlsplit(url).netloc
 
 
-def _y_get_tags(symbols, tags):
-    """Get multiple Yahoo! tag values for multiple symbols.
-
-    This is similar to _y_get_tag(), but a little more versatile with
-    cleaner output (dictionary).
+def provider_guard(provider):
+    """Get the ProviderGuard for a provider, creating it if needed.
 
     Args:
-        symbols: Stock symbol or, confusingly, list of stock symbols.
-        tags: Tag name, tag, or, confusingly, list of tag names or tags.
-            NOTE: Tag combination strings are no longer allowed.
-        Examples:
-            'trade_date' # tag name
-            'd2'         # tag
-            ['trade_date', 'd2'] # list of tag names and/or tags
+        provider: API name ('google' or 'yahoo') or host name.
 
     Returns:
-        Dictionary of symbols with dictionary of tag values requested.
-        {
-            symbol1: {
-                key1: value1,
-                ..
-                keyN: valueN,
-                },
-            ..
-            symbolM: {
-                key1: value1,
-                ..
-                keyN: valueN,
-                },
-            }
+        ProviderGuard instance.
     """
-    if isinstance(symbols, str):
-        symbols = [symbols]
-    if isinstance(tags, str):
-        tags = [tags]
-    tag_parts = []
-    tag_names = []
-    for tag in tags:
-        if tag in Y_TAGS:
-            # tag is actually a tag name; get the tag from value
-            tag_names.append(tag)
-            tag_parts.append(Y_TAGS[tag])
-        elif tag in Y_TAGS.values():
-            # tag is really a tag; get the name from key
-            for tag_name, tag_abbr in Y_TAGS.items():
-                if tag == tag_abbr:
-                    tag_names.append(tag_name)
-                    tag_parts.append(tag_abbr)
-                    break
-        else:
-            # Unknown tag; pass tag with "unknown" as name
-            tag_names.append('unknown')
-            tag_parts.append(tag)
-    tag_string = ''.join(tag_parts)
-    symbol_data = _request_y_symbols(symbols, tag_string)
-    symbol_dict = {}
-    for symbol in symbols:
-        symbol_new = symbol.strip('^.')
-        symbol_dict[symbol_new] = {}
-        for tag_index, tag_name in enumerate(tag_names):
-            symbol_dict[symbol_new][tag_name] = symbol_data[symbol][tag_index]
-    return symbol_dict
+    guard = PROVIDERS.get(provider)
+    if guard is None:
+        with _PROVIDERS_LOCK:
+            guard = PROVIDERS.setdefault(provider, ProviderGuard())
+    return guard
 
 
-def _g_get_all(symbols):
-    """Get all Google quote data for the given ticker symbols.
+def provider_available(provider):
+    """Check whether requests to a provider would currently be sent.
 
     Args:
-        symbols: Stock symbol or, confusingly, list of stock symbols.
+        provider: API name ('google' or 'yahoo') or host name.
 
     Returns:
-        Dictionary of symbols with dictionary of tag values requested.
+        False while the provider's circuit is open.
     """
-    if isinstance(symbols, str):
-        symbols = [symbols]
-    symbols = conform_symbols(symbols, 'google')
-    symbol_string = ','.join(symbols)
-    url = '%s?client=ig&q=%s' % (G_QUOTE_URL, symbol_string)
-    content = _request(url)
-    if content.startswith('//'):
-        content = content[2:].strip()
-    symbol_dict = {}
-    if content:
-        content = json.loads(content)
-        # Reverse the dictionary
-        g_tag_fixed = {}
-        for tag_name, tag_value in G_TAGS.items():
-            g_tag_fixed[tag_value] = tag_name
-
-        for symbol_data in content:
-            symbol = symbol_data['t'].strip('^.')
-            symbol_dict[symbol] = {}
-            for tag_name, tag_value in symbol_data.items():
-                if tag_name in g_tag_fixed:
-                    symbol_dict[symbol][g_tag_fixed[tag_name]] = tag_value
-    LOGGER.debug('_g_get_all: %s', repr(symbol_dict))
-    return symbol_dict
+    return provider_guard(provider).breaker.state != CircuitBreaker.OPEN
 
 
-def conform_symbols(symbols, fapi=DEFAULT_API):
-    """Conform symbol names to the fapi ('google' or 'yahoo').
+def provider_status():
+    """Get rate limiter and circuit breaker state, e.g., for metrics.
+
+    Returns:
+        Dictionary of provider name to dictionary of values; 'state' is
+        an index into CircuitBreaker.STATES (0 closed, 1 half-open,
+        2 open).
+    """
+    status = {}
+    for provider, guard in list(PROVIDERS.items()):
+        breaker = guard.breaker
+        status[provider] = {
+            'state': CircuitBreaker.STATES.index(breaker.state),
+            'failures': breaker.failures,
+            'opens': breaker.opens,
+            'rejected': breaker.rejected,
+            'rate': guard.limiter.rate,
+            }
+    return status
+
+
+def _guard_request(url):
+    """Apply the provider's circuit breaker and rate limiter.
 
     Args:
-        symbols: List of ticker symbols.
-        fapi: Financial data API; currently 'google' or 'yahoo'.
+        url: Request URL.
 
     Returns:
-        List of symbols conformed to the fapi.
+        ProviderGuard to report the outcome to, or None if the circuit
+        is open and the request must not be sent.
     """
-    fapi = fapi.lower()[0]
-    final_symbols = []
-    for symbol in symbols:
-        parts = symbol.split(':')
-        if len(parts) > 1:
-            exchange = parts[0]
-            symbol = parts[1]
-        else:
-            exchange = ''
-            symbol = parts[0]
-        if fapi == 'g':
-            symbol = symbol.replace('^', '.')
-            if exchange:
-                symbol = '%s:%s' % (exchange, symbol)
-        else:
-            symbol = symbol.replace('.', '^')
-        symbol = symbol.upper()
-        final_symbols.append(symbol)
-    return final_symbols
+    provider = _url_provider(url)
+    guard = provider_guard(provider)
+    if not guard.breaker.allow():
+        LOGGER.warning('_request: circuit open for %s; request skipped',
+                       provider)
+        _count('rejected')
+        return None
+    guard.limiter.acquire()
+    return guard
 
 
-def get_all(symbols, fapi=DEFAULT_API):
-    """Get all available quote data for the given ticker symbols.
+def _record_status(guard, status):
+    """Report a response status to the provider's guard.
 
     Args:
-        symbols: Stock symbol or, confusingly, list of stock symbols.
-        fapi: Financial data API; currently 'google' or 'yahoo'.
+        guard: ProviderGuard from _guard_request().
+        status: HTTP status code, or None if the request failed.
+    """
+    if status is None or status >= 500 or status in THROTTLE_CODES:
+        guard.breaker.record_failure()
+        if status is not None:
+            guard.limiter.throttled()
+    else:
+        guard.breaker.record_success()
+        guard.limiter.succeeded()
+
+
+def _request(url):
+    """Makes the URL info request.
+
+    Requests go through the module-level connection pool (POOL), so
+    repeated requests to the same host reuse their connection, and
+    through the provider's rate limiter and circuit breaker (PROVIDERS).
+
+    Args:
+        url: URL that returns data.
 
     Returns:
-        Dictionary of symbols with dictionary of tag values requested.
+        Response string; empty on HTTP errors or if the provider's
+        circuit is open.
     """
-    fapi = fapi.lower()[0]
-    if fapi == 'g':
-        symbol_dict = _g_get_all(symbols)
+    LOGGER.debug('_request URL: %s', url)
+    guard = _guard_request(url)
+    if guard is None:
+        return ''
+    with _Stage('request'):
+        try:
+            status, reason, body = POOL.request(url)
+        except (HTTPException, socket.error):
+            _record_status(guard, None)
+            raise
+    _record_status(guard, status)
+    _count('bytes_received', len(body))
+    if status >= 400:
+        LOGGER.error('_request: HTTPError %s: %s', status, reason)
+        _count('errors')
+        content = ''
     else:
-        symbol_dict = _y_get_all(symbols)
-    return symbol_dict
+        content = body.decode().strip()
+    LOGGER.debug('_request content: %s', content)
+    return content
+
+
+class QuoteCache(object):
+    """In-memory quote cache with a time-to-live and LRU eviction.
+
+    Entries are keyed by (api, symbol, tag) tuples.  Entries older than
+    ttl seconds are treated as missing; once max_entries is reached,
+    the least recently used entry is evicted.
+
+    To enable caching for all requests, assign an instance to the
+    module-level QUOTE_CACHE:
+        kstock.QUOTE_CACHE = kstock.QuoteCache(ttl=2)
+    """
+
+    def __init__(self, ttl=DEFAULT_CACHE_TTL,
+                 max_entries=DEFAULT_CACHE_ENTRIES):
+        """Set up an empty cache.
+
+        Args:
+            ttl: Seconds an entry stays fresh.
+            max_entries: Maximum number of entries kept.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Look up a fresh cache entry.
+
+        Args:
+            key: (api, symbol, tag) tuple.
+
+        Returns:
+            Cached value, or None if missing or stale.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires < time.time():
+                self.expirations += 1
+                self.misses += 1
+                return None
+            # Re-insert to mark as most recently used.
+            self._entries[key] = entry
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Add or refresh a cache entry.
+
+        Args:
+            key: (api, symbol, tag) tuple.
+            value: Value to cache; must not be None.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Remove all entries; counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Get cache counters, e.g., for monitoring.
+
+        Returns:
+            Dictionary of counter names and values.
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                }
+
+
+# Shared quote cache; None disables caching.
+QUOTE_CACHE = None
+
+
+class _Flight(object):
+    """A fetch in progress; see SingleFlight."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.values = {}
+
+
+class SingleFlight(object):
+    """Coalesce concurrent fetches of the same (api, symbol, tag) keys.
+
+    A caller asking for keys that another caller is already fetching
+    waits for that fetch instead of making its own request, and only
+    fetches the keys nobody else is fetching.
+    """
+
+    def __init__(self):
+        """Set up with nothing in flight.
+        """
+        self.shared = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, api, keys, fetch):
+        """Fetch keys, sharing in-flight fetches with other callers.
+
+        Args:
+            api: Financial data API; 'google' or 'yahoo'.
+            keys: List of (symbol, tag) tuples.
+            fetch: Function taking a list of (symbol, tag) tuples and
+                returning a dictionary of values keyed by them.
+
+        Returns:
+            Dictionary of values keyed by (symbol, tag) tuple; keys that
+            could not be fetched are left out.
+        """
+        flight = _Flight()
+        own_keys = []
+        waits = []
+        with self._lock:
+            for key in OrderedDict.fromkeys(keys):
+                other = self._flights.get((api,) + key)
+                if other is None:
+                    self._flights[(api,) + key] = flight
+                    own_keys.append(key)
+                else:
+                    waits.append((key, other))
+            self.shared += len(waits)
+        values = {}
+        if own_keys:
+            try:
+                flight.values = fetch(own_keys)
+            finally:
+                with self._lock:
+                    for key in own_keys:
+                        del self._flights[(api,) + key]
+                flight.event.set()
+            values.update(flight.values)
+        for key, other in waits:
+            other.event.wait()
+            if key in other.values:
+                values[key] = other.values[key]
+        return values
+
+
+# Shared registry of in-flight fetches.
+FLIGHTS = SingleFlight()
+
+
+def _fetch_and_store(api, cache, fetch, keys):
+    """Fetch keys and add the values to the cache.
+
+    Args:
+        api: Financial data API; 'google' or 'yahoo'.
+        cache: QuoteCache, or None.
+        fetch: Function taking a list of (symbol, tag) tuples and
+            returning a dictionary of values keyed by them.
+        keys: List of (symbol, tag) tuples.
+
+    Returns:
+        Dictionary returned by fetch.
+    """
+    values = fetch(keys)
+    if cache is not None:
+        for key, value in values.items():
+            cache.put((api,) + key, value)
+    return values
+
+
+def _cached_fetch(api, keys, fetch):
+    """Get values from QUOTE_CACHE, fetching only missing or stale ones.
+
+    Fetches go through FLIGHTS, so concurrent callers asking for the
+    same keys share a single request.
+
+    Args:
+        api: Financial data API; 'google' or 'yahoo'.
+        keys: List of (symbol, tag) tuples.
+        fetch: Function taking a list of (symbol, tag) tuples and
+            returning a dictionary of the values it could get, keyed by
+            (symbol, tag) tuple.
+
+    Returns:
+        Dictionary of values keyed by (symbol, tag) tuple; keys that
+        could not be fetched are left out.
+    """
+    cache = QUOTE_CACHE
+    values = {}
+    if cache is None:
+        missing = keys
+    else:
+        missing = []
+        for key in keys:
+            value = cache.get((api,) + key)
+            if value is None:
+                missing.append(key)
+            else:
+                values[key] = value
+    if missing:
+        fetch = partial(_fetch_and_store, api, cache, fetch)
+        values.update(FLIGHTS.fetch(api, missing, fetch))
+    return values
+
+
+def _symbol_key(symbol):
+    """Get the result dictionary key for a symbol.
+
+    Args:
+        symbol: Stock symbol, possibly with exchange prefix.
+
+    Returns:
+        Symbol without exchange prefix or index marker ('^' or '.').
+    """
+    return symbol.split(':')[-1].strip('^.')
+
+
+# Placeholder in Quote rows for values the response did not include.
+_MISSING = object()
+
+
+class _QuoteLayout(object):
+    """Tag names of Quote records and how to parse their raw data.
+
+    One layout is shared by all quotes with the same tag names.
+    """
+
+    __slots__ = ('names', 'index', 'width', 'parse')
+
+    def __init__(self, names, parse=None):
+        """Set up the layout.
+
+        Args:
+            names: Tag names, in row order; a repeated name takes the
+                value of its last position.
+            parse: Function turning raw data into a row list; None if
+                the raw data already is the row list.
+        """
+        self.index = dict((name, position)
+                          for position, name in enumerate(names))
+        self.names = tuple(name for position, name in enumerate(names)
+                           if self.index[name] == position)
+        self.width = len(names)
+        self.parse = parse
+
+
+class Quote(MutableMapping):
+    """Quote data for one symbol: a dictionary of tag names to values.
+
+    The raw response data (a CSV line or a decoded JSON object) is kept
+    as is and only split into values the first time one is looked up,
+    so quotes that are never read cost little more than their raw
+    data.  Values set or deleted by the caller are kept apart from the
+    row, so copies share parsed rows safely.  Use dict(quote) where a
+    real dictionary is needed, e.g., for json.dumps().
+    """
+
+    __slots__ = ('_layout', '_raw', '_row', '_changes')
+
+    def __init__(self, layout, raw):
+        """Set up the quote.
+
+        Args:
+            layout: _QuoteLayout shared by quotes of the same tags.
+            raw: Raw data for layout.parse, or the row list.
+        """
+        self._layout = layout
+        self._raw = raw
+        self._row = None
+        self._changes = None
+
+    def _values(self):
+        """Get the row, parsing the raw data on first use.
+        """
+        row = self._row
+        if row is None:
+            row = self._raw
+            if self._layout.parse is not None:
+                row = self._layout.parse(row)
+            if len(row) < self._layout.width:
+                # Short response line; the last values are missing.
+                row = row + [_MISSING] * (self._layout.width - len(row))
+            self._row = row
+            self._raw = None
+        return row
+
+    def _lookup(self, name):
+        if self._changes is not None and name in self._changes:
+            return self._changes[name]
+        position = self._layout.index.get(name)
+        if position is None:
+            return _MISSING
+        return self._values()[position]
+
+    def __getitem__(self, name):
+        value = self._lookup(name)
+        if value is _MISSING:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self._lookup(name) is not _MISSING
+
+    def __setitem__(self, name, value):
+        if self._changes is None:
+            self._changes = {}
+        self._changes[name] = value
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self[name] = _MISSING
+
+    def __iter__(self):
+        changes = self._changes or {}
+        for name in self._layout.names:
+            if name not in changes and self._lookup(name) is not _MISSING:
+                yield name
+        for name, value in changes.items():
+            if value is not _MISSING:
+                yield name
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        """Get a shallow copy that shares the parsed row, if any.
+
+        Returns:
+            Quote instance.
+        """
+        quote = Quote(self._layout, self._raw)
+        quote._row = self._row
+        if self._changes is not None:
+            quote._changes = dict(self._changes)
+        return quote
+
+
+def _parse_csv_line(line):
+    """Split one CSV line into values; parse function for Quote."""
+    for row in csv.reader([line]):
+        return row
+    return []
+
+
+def _parse_json_quote(tags, symbol_data):
+    """Pick tag values out of a decoded JSON object; parse function for
+    Quote.
+    """
+    return [symbol_data.get(tag, _MISSING) for tag in tags]
+
+
+def _g_layout(fields=None):
+    """Get the (cached) layout of Google quotes with the given fields.
+
+    Args:
+        fields: Tuple of tag names; None for one name per tag in
+            G_TAG_NAMES.  Names not in G_TAGS are left out.
+
+    Returns:
+        _QuoteLayout instance.
+    """
+    layout = _G_LAYOUTS.get(fields)
+    if layout is None:
+        if fields is None:
+            tags = sorted(G_TAG_NAMES)
+            names = [G_TAG_NAMES[tag] for tag in tags]
+        else:
+            names = [name for name in fields if name in G_TAGS]
+            tags = [G_TAGS[name] for name in names]
+        layout = _QuoteLayout(names, partial(_parse_json_quote, tags))
+        if len(_G_LAYOUTS) >= MAX_TAG_PLANS:
+            _G_LAYOUTS.clear()
+        _G_LAYOUTS[fields] = layout
+    return layout
+
+
+def _y_layout(tag_names, raw_lines=False):
+    """Get the (cached) layout of Yahoo! quotes with the given tags.
+
+    Args:
+        tag_names: Tuple of tag names, in request order.
+        raw_lines: If True, quotes hold CSV lines; otherwise rows.
+
+    Returns:
+        _QuoteLayout instance.
+    """
+    key = (tag_names, raw_lines)
+    layout = _Y_LAYOUTS.get(key)
+    if layout is None:
+        layout = _QuoteLayout(tag_names,
+                              _parse_csv_line if raw_lines else None)
+        if len(_Y_LAYOUTS) >= MAX_TAG_PLANS:
+            _Y_LAYOUTS.clear()
+        _Y_LAYOUTS[key] = layout
+    return layout
+
+
+def _request_lines(url, chunk_size=STREAM_CHUNK_SIZE):
+    """Makes the URL info request, generating response lines.
+
+    The response is read and decoded incrementally, so only one chunk
+    of it is held in memory at a time.
+
+    Args:
+        url: URL that returns line-based data.
+        chunk_size: Number of bytes read at a time.
+
+    Yields:
+        Response lines, without line endings.
+    """
+    LOGGER.debug('_request_lines URL: %s', url)
+    guard = _guard_request(url)
+    if guard is None:
+        return
+    try:
+        status, reason, chunks = POOL.stream(url, chunk_size)
+    except (HTTPException, socket.error):
+        _record_status(guard, None)
+        raise
+    _record_status(guard, status)
+    try:
+        if status >= 400:
+            LOGGER.error('_request_lines: HTTPError %s: %s', status, reason)
+            _count('errors')
+            return
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        pending = ''
+        for chunk in chunks:
+            _count('bytes_received', len(chunk))
+            lines = (pending + decoder.decode(chunk)).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.rstrip('\r')
+        pending += decoder.decode(b'', True)
+        if pending:
+            yield pending.rstrip('\r')
+    finally:
+        chunks.close()
+
+
+def _y_quote_url(symbols, tag_string):
+    """Build the Yahoo! Finance info request URL.
+
+    Args:
+        symbols: Stock symbol or, confusingly, list of stock symbols.
+        tag_string: Tag or, confusingly, tag combination.
+
+    Returns:
+        (symbols, url) tuple; symbols conformed to Yahoo!, in request
+        order.
+    """
+    if isinstance(symbols, str):
+        symbols = [symbols]
+    symbols = conform_symbols(symbols, 'yahoo')
+    symbol_string = '+'.join(symbols)
+    url = '%s?s=%s&f=%s' % (Y_QUOTE_URL, symbol_string, tag_string)
+    _count('symbols_per_request', len(symbols))
+    return symbols, url
+
+
+def _iter_y_symbols(symbols, tag_string):
+    """Makes the Yahoo! Finance info request, generating symbol rows.
+
+    This is the streaming version of _request_y_symbols(): rows are
+    parsed as they arrive instead of after the whole response has been
+    read.
+
+    Args:
+        symbols: Stock symbol or, confusingly, list of stock symbols.
+        tag_string: Tag or, confusingly, tag combination.
+
+    Yields:
+        (symbol, [value1, .., valueN]) tuples, in request order.
+    """
+    symbols, url = _y_quote_url(symbols, tag_string)
+    lines = (line for line in _request_lines(url) if line.strip())
+    csv_reader = csv.reader(lines, delimiter=',')
+    for index, row in enumerate(csv_reader):
+        if index >= len(symbols):
+            break
+        yield symbols[index], row
+
+
+def _request_y_symbols(symbols, tag_string):
+    """Makes the Yahoo! Finance info request.
+
+    Args:
+        symbols: Stock symbol or, confusingly, list of stock symbols.
+        tag_string: Tag or, confusingly, tag combination.
+            Examples:
+                'p1'   # single tag
+                'np1v' # tag combination
+
+    Returns:
+        Dictionary with symbols as keys and list of tag values as
+        values.
+        {
+            symbol1: [value1, .., valueN],
+            ..
+            symbolM: [value1, .., valueN],
+            }
+    """
+    symbols, url = _y_quote_url(symbols, tag_string)
+    content = _request(url)
+    with _Stage('parse'):
+        csv_reader = csv.reader(content.splitlines(), delimiter=',')
+        return_dict = dict(zip(symbols, csv_reader))
+    return return_dict
+
+
+def _y_fetch(keys):
+    """Fetch Yahoo! tag values for (symbol, tag) pairs in one request.
+
+    Every symbol is requested with every tag; see _cached_fetch().
+
+    Args:
+        keys: List of (symbol, tag) tuples; symbols must already be
+            conformed to Yahoo!.
+
+    Returns:
+        Dictionary of tag values keyed by (symbol, tag) tuple.
+    """
+    symbols = []
+    tags = []
+    for symbol, tag in keys:
+        if symbol not in symbols:
+            symbols.append(symbol)
+        if tag not in tags:
+            tags.append(tag)
+    symbol_data = _request_y_symbols(symbols, ''.join(tags))
+    values = {}
+    with _Stage('transform'):
+        for symbol, row in symbol_data.items():
+            for tag, value in zip(tags, row):
+                values[(symbol, tag)] = value
+    return values
+
+
+def _y_fetch_all(keys):
+    """Fetch all Yahoo! quote data for (symbol, ALL_TAGS) pairs.
+
+    Response lines are kept unparsed in Quote records; see
+    _cached_fetch().
+
+    Args:
+        keys: List of (symbol, ALL_TAGS) tuples; symbols must already
+            be conformed to Yahoo!.
+
+    Returns:
+        Dictionary of Quote records keyed by (symbol, ALL_TAGS) tuple.
+    """
+    tag_names, tag_parts = _y_tag_plan(Y_ALL_TAG_NAMES)
+    layout = _y_layout(tag_names, raw_lines=True)
+    symbols, url = _y_quote_url([symbol for symbol, _ in keys],
+                                ''.join(tag_parts))
+    content = _request(url)
+    values = {}
+    with _Stage('transform'):
+        for symbol, line in zip(symbols, content.splitlines()):
+            if line.strip():
+                values[(symbol, ALL_TAGS)] = Quote(layout, line)
+    return values
+
+
+def _y_tag_plan(tags):
+    """Resolve tag names and tags to (names, tags) columns.
+
+    Plans are cached per distinct tag list, so repeated calls with the
+    same tags cost a single dictionary lookup.
+
+    Args:
+        tags: List of tag names and/or tags.
+
+    Returns:
+        (tag_names, tag_parts) tuple of tuples, in the order of tags.
+        Unknown tags are passed through with 'unknown' as name.
+    """
+    tags = tuple(tags)
+    plan = _Y_TAG_PLANS.get(tags)
+    if plan is None:
+        tag_names = []
+        tag_parts = []
+        for tag in tags:
+            if tag in Y_TAGS:
+                # tag is actually a tag name; get the tag from value
+                tag_names.append(tag)
+                tag_parts.append(Y_TAGS[tag])
+            elif tag in Y_TAG_NAMES:
+                # tag is really a tag; get the name from the registry
+                tag_names.append(Y_TAG_NAMES[tag])
+                tag_parts.append(tag)
+            else:
+                # Unknown tag; pass tag with "unknown" as name
+                tag_names.append('unknown')
+                tag_parts.append(tag)
+        plan = (tuple(tag_names), tuple(tag_parts))
+        if len(_Y_TAG_PLANS) >= MAX_TAG_PLANS:
+            _Y_TAG_PLANS.clear()
+        _Y_TAG_PLANS[tags] = plan
+    return plan
+
+
+def _y_get_all(symbols):
+    """Get all Yahoo! quote data for the given ticker symbols.
+
+    Args:
+        symbols: Stock symbol or, confusingly, list of stock symbols.
+
+    Returns:
+        Dictionary of symbols with Quote (dictionary of tag values)
+        requested.  See _y_get_tags().
+    """
+    if isinstance(symbols, str):
+        symbols = [symbols]
+    symbols = conform_symbols(symbols, 'yahoo')
+    keys = [(symbol, ALL_TAGS) for symbol in symbols]
+    values = _cached_fetch('yahoo', keys, _y_fetch_all)
+    symbol_dict = {}
+    for key in keys:
+        if key in values:
+            # Copy, so callers cannot modify cached quotes.
+            symbol_dict[key[0].strip('^.')] = values[key].copy()
+    return symbol_dict
+
+
+def _y_get_tag(symbols, tag_string):
+    """Get Yahoo! tag values for multiple symbols.
+
+    Args:
+        symbols: Stock symbol or, confusingly, list of stock symbols.
+        tag_string: Tag name, tag, or, confusingly, tag combination.
+        Examples:
+            'trade_date' # tag name
+            'd2'         # tag
+            'nd1d2'      # tag combination
+
+    Returns:
+        Dictionary of symbols with list of tag values requested.
+        {
+            symbol1: [value1, .., valueN],
+            ..
+            symbolN: [value1, .., valueN],
+            }
+    """
+    if tag_string in Y_TAGS:
+        tag_string = Y_TAGS[tag_string]
+    tag_parts = Y_TAG_PATTERN.findall(tag_string)
+    if ''.join(tag_parts) != tag_string:
+        # Not a plain tag combination; pass it through uncached.
+        return _request_y_symbols(symbols, tag_string)
+    if isinstance(symbols, str):
+        symbols = [symbols]
+    symbols = conform_symbols(symbols, 'yahoo')
+    keys = [(symbol, tag) for symbol in symbols for tag in tag_parts]
+    values = _cached_fetch('yahoo', keys, _y_fetch)
+    return_dict = {}
+    for symbol in symbols:
+        if all((symbol, tag) in values for tag in tag_parts):
+            return_dict[symbol] = [values[(symbol, tag)]
+                                   for tag in tag_parts]
+    return return_dict
+
+
+def _y_get_tags(symbols, tags):
+    """Get multiple Yahoo! tag values for multiple symbols.
+
+    This is similar to _y_get_tag(), but a little more versatile with
+    cleaner output (dictionary).
+
+    Args:
+        symbols: Stock symbol or, confusingly, list of stock symbols.
+        tags: Tag name, tag, or, confusingly, list of tag names or tags.
+            NOTE: Tag combination strings are no longer allowed.
+        Examples:
+            'trade_date' # tag name
+            'd2'         # tag
+            ['trade_date', 'd2'] # list of tag names and/or tags
+
+    Returns:
+        Dictionary of symbols with Quote (dictionary of tag values)
+        requested.
+        {
+            symbol1: {
+                key1: value1,
+                ..
+                keyN: valueN,
+                },
+            ..
+            symbolM: {
+                key1: value1,
+                ..
+                keyN: valueN,
+                },
+            }
+    """
+    if isinstance(symbols, str):
+        symbols = [symbols]
+    if isinstance(tags, str):
+        tags = [tags]
+    tag_names, tag_parts = _y_tag_plan(tags)
+    layout = _y_layout(tag_names)
+    symbols = conform_symbols(symbols, 'yahoo')
+    keys = [(symbol, tag) for symbol in symbols for tag in tag_parts]
+    values = _cached_fetch('yahoo', keys, _y_fetch)
+    symbol_dict = {}
+    for symbol in symbols:
+        try:
+            row = [values[(symbol, tag)] for tag in tag_parts]
+        except KeyError:
+            continue
+        symbol_dict[symbol.strip('^.')] = Quote(layout, row)
+    return symbol_dict
+
+
+def _y_iter_tags(symbols, tags):
+    """Generate multiple Yahoo! tag values for multiple symbols.
+
+    This is the streaming version of _y_get_tags(): quotes are yielded
+    as the response arrives, so memory use does not grow with the
+    number of symbols.  QUOTE_CACHE is not used.
+
+    Args:
+        symbols: Stock symbol or, confusingly, list of stock symbols.
+        tags: Tag name, tag, or, confusingly, list of tag names or tags.
+
+    Yields:
+        (symbol, Quote) tuples; see _y_get_tags().
+    """
+    if isinstance(tags, str):
+        tags = [tags]
+    tag_names, tag_parts = _y_tag_plan(tags)
+    layout = _y_layout(tag_names)
+    for symbol, row in _iter_y_symbols(symbols, ''.join(tag_parts)):
+        yield symbol.strip('^.'), Quote(layout, row)
+
+
+def _g_fetch(keys):
+    """Fetch all Google quote data for (symbol, ALL_TAGS) pairs.
+
+    Google always sends every tag, so the decoded JSON objects are
+    kept as they are; _g_get_all() wraps them in Quote records that
+    pick out the requested fields.  See _cached_fetch().
+
+    Args:
+        keys: List of (symbol, ALL_TAGS) tuples; symbols must already
+            be conformed to Google.
+
+    Returns:
+        Dictionary of decoded JSON objects (tags and values), keyed by
+        (symbol, ALL_TAGS) tuple.
+    """
+    symbols = [symbol for symbol, _ in keys]
+    symbol_string = ','.join(symbols)
+    url = '%s?client=ig&q=%s' % (G_QUOTE_URL, symbol_string)
+    _count('symbols_per_request', len(symbols))
+    content = _request(url)
+    if content.startswith('//'):
+        content = content[2:].strip()
+    quotes = {}
+    if content:
+        with _Stage('parse'):
+            content = json.loads(content)
+        with _Stage('transform'):
+            for symbol_data in content:
+                quotes[_symbol_key(symbol_data['t'])] = symbol_data
+    values = {}
+    for key in keys:
+        symbol_key = _symbol_key(key[0])
+        if symbol_key in quotes:
+            values[key] = quotes[symbol_key]
+    return values
+
+
+def _g_get_all(symbols, fields=None):
+    """Get all (or selected) Google quote data for the given symbols.
+
+    Args:
+        symbols: Stock symbol or, confusingly, list of stock symbols.
+        fields: Tag names to include; default: all.  Google has no
+            way to request fewer tags, so the others are dropped while
+            parsing.
+
+    Returns:
+        Dictionary of symbols with Quote (dictionary of tag values)
+        requested.
+    """
+    if isinstance(symbols, str):
+        symbols = [symbols]
+    if fields is not None:
+        fields = tuple(fields)
+    layout = _g_layout(fields)
+    symbols = conform_symbols(symbols, 'google')
+    keys = [(symbol, ALL_TAGS) for symbol in symbols]
+    values = _cached_fetch('google', keys, _g_fetch)
+    symbol_dict = {}
+    for key in keys:
+        if key in values:
+            # Quote changes never reach the cached JSON object.
+            symbol_dict[_symbol_key(key[0])] = Quote(layout, values[key])
+    # Formatted only at DEBUG level, so quotes stay unparsed otherwise.
+    LOGGER.debug('_g_get_all: %r', symbol_dict)
+    return symbol_dict
+
+
+SymbolForms = namedtuple('SymbolForms', ['canonical', 'google', 'yahoo'])
+SymbolForms.__doc__ = """Forms of a ticker symbol.
+
+Attributes:
+    canonical: Canonical form; same as google, which keeps the exchange
+        prefix (e.g., 'INDEXNASDAQ:.IXIC').
+    google: Form used by Google (e.g., 'NASDAQ:BRCD', '.SPXPM').
+    yahoo: Form used by Yahoo! (e.g., 'BRCD', '^SPXPM').
+"""
+
+
+def _parse_symbol(symbol):
+    """Work out the forms of a ticker symbol.
+
+    Args:
+        symbol: Ticker symbol in any form.
+
+    Returns:
+        SymbolForms instance.
+    """
+    parts = symbol.split(':')
+    if len(parts) > 1:
+        exchange = parts[0]
+        symbol = parts[1]
+    else:
+        exchange = ''
+        symbol = parts[0]
+    g_symbol = symbol.replace('^', '.')
+    if exchange:
+        g_symbol = '%s:%s' % (exchange, g_symbol)
+    g_symbol = g_symbol.upper()
+    y_symbol = symbol.replace('.', '^').upper()
+    return SymbolForms(g_symbol, g_symbol, y_symbol)
+
+
+def symbol_forms(symbol):
+    """Get the forms of a ticker symbol, parsing it only once.
+
+    The canonical form maps to the same forms, so converting a symbol
+    to Google and then to Yahoo! does not parse it again.
+
+    Args:
+        symbol: Ticker symbol in any form.
+
+    Returns:
+        SymbolForms instance.
+    """
+    forms = _SYMBOL_FORMS.get(symbol)
+    if forms is None:
+        forms = _parse_symbol(symbol)
+        if len(_SYMBOL_FORMS) >= MAX_SYMBOL_FORMS:
+            _SYMBOL_FORMS.clear()
+        _SYMBOL_FORMS[symbol] = forms
+        _SYMBOL_FORMS[forms.canonical] = forms
+    return forms
+
+
+def normalize_symbols(symbols):
+    """Get the forms of many ticker symbols at once.
+
+    Args:
+        symbols: List of ticker symbols in any form.
+
+    Returns:
+        List of SymbolForms instances, in the same order.
+    """
+    get_forms = _SYMBOL_FORMS.get
+    return [get_forms(symbol) or symbol_forms(symbol) for symbol in symbols]
+
+
+def conform_symbols(symbols, fapi=DEFAULT_API):
+    """Conform symbol names to the fapi ('google' or 'yahoo').
+
+    Args:
+        symbols: List of ticker symbols.
+        fapi: Financial data API; currently 'google' or 'yahoo'.
+
+    Returns:
+        List of symbols conformed to the fapi.
+    """
+    if fapi.lower()[0] == 'g':
+        return [forms.google for forms in normalize_symbols(symbols)]
+    return [forms.yahoo for forms in normalize_symbols(symbols)]
+
+
+def _chunk_symbols(symbols, batch_size):
+    """Split a list of symbols into batches.
+
+    Args:
+        symbols: List of stock symbols.
+        batch_size: Maximum number of symbols per batch.
+
+    Returns:
+        List of symbol lists, in the original order.
+    """
+    batch_size = max(1, batch_size)
+    return [symbols[index:index + batch_size]
+            for index in range(0, len(symbols), batch_size)]
+
+
+def _fetch_batch(fetch, batch):
+    """Fetch one batch of symbols, logging errors instead of raising.
+
+    Args:
+        fetch: Function taking a list of symbols and returning a
+            dictionary of symbols; e.g., _g_get_all().
+        batch: List of stock symbols.
+
+    Returns:
+        Dictionary returned by fetch; empty if the batch failed.
+    """
+    try:
+        symbol_dict = fetch(batch)
+    except BATCH_ERRORS as err:
+        LOGGER.error('_fetch_batch: %d symbols failed: %s', len(batch), err)
+        _count('errors')
+        symbol_dict = {}
+    return symbol_dict
+
+
+def _fetch_batches(fetch, batches, max_workers=None):
+    """Fetch batches of symbols, concurrently if there are several.
+
+    Args:
+        fetch: Function taking a list of symbols and returning a
+            dictionary of symbols; e.g., _g_get_all().
+        batches: List of symbol lists.
+        max_workers: Maximum number of concurrent requests; defaults
+            to DEFAULT_MAX_WORKERS.
+
+    Returns:
+        Dictionary merged from the results of all successful batches.
+    """
+    if max_workers is None:
+        max_workers = DEFAULT_MAX_WORKERS
+    workers = min(max_workers, len(batches))
+    fetch_batch = partial(_fetch_batch, fetch)
+    if workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(fetch_batch, batches)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [fetch_batch(batch) for batch in batches]
+    symbol_dict = {}
+    for result in results:
+        symbol_dict.update(result)
+    return symbol_dict
+
+
+def get_all(symbols, fapi=DEFAULT_API, batch_size=None, max_workers=None,
+            columnar=False, fields=None):
+    """Get all available quote data for the given ticker symbols.
+
+    Large symbol lists are split into batches (see BATCH_SIZES) that
+    are fetched concurrently; a failed batch is logged and left out of
+    the result without affecting the other batches.
+
+    With fields, only those tags are returned: Yahoo! is asked for just
+    those tags, while Google responses (which always hold every tag)
+    are trimmed while parsing.
+
+    Args:
+        symbols: Stock symbol or, confusingly, list of stock symbols.
+        fapi: Financial data API; currently 'google' or 'yahoo'.
+        batch_size: Maximum number of symbols per request; defaults to
+            the fapi entry in BATCH_SIZES.
+        max_workers: Maximum number of concurrent requests; defaults
+            to DEFAULT_MAX_WORKERS.
+        columnar: If True, return a QuoteTable (requires numpy).
+        fields: List of tag names to get; default: all.  Names the
+            fapi does not know are ignored.
+
+    Returns:
+        Dictionary of symbols with Quote (dictionary of tag values)
+        requested, or QuoteTable if columnar is True.
+    """
+    if isinstance(symbols, str):
+        symbols = [symbols]
+    if isinstance(fields, str):
+        fields = [fields]
+    fapi = fapi.lower()[0]
+    if fapi == 'g':
+        api = 'google'
+        fetch = _g_get_all
+        if fields is not None:
+            fetch = partial(_g_get_all, fields=fields)
+    else:
+        api = 'yahoo'
+        fetch = _y_get_all
+        if fields is not None:
+            fields = [field for field in fields
+                      if field in Y_TAGS or field in Y_TAG_NAMES]
+            fetch = partial(_y_get_tags, tags=fields)
+    if batch_size is None:
+        batch_size = BATCH_SIZES[api]
+    batches = _chunk_symbols(list(symbols), batch_size)
+    symbol_dict = _fetch_batches(fetch, batches, max_workers)
+    if columnar:
+        return QuoteTable.from_quotes(symbol_dict)
+    return symbol_dict
+
+
+def _provider_fetch(api, symbols, fields):
+    """Get selected tag values from one API, without raising errors.
+
+    Args:
+        api: Financial data API; 'google' or 'yahoo'.
+        symbols: List of stock symbols.
+        fields: List of tag names.
+
+    Returns:
+        Dictionary of symbols with Quote (dictionary of tag values);
+        empty if the request failed.
+    """
+    try:
+        if api == 'google':
+            quotes = _g_get_all(symbols, fields)
+        else:
+            quotes = _y_get_tags(symbols, fields)
+    except BATCH_ERRORS as err:
+        LOGGER.error('_provider_fetch: %s failed for %d symbols: %s', api,
+                     len(symbols), err)
+        _count('errors')
+        quotes = {}
+    return quotes
+
+
+def _run_provider(results, api, symbols, fields):
+    """Put the result of _provider_fetch() on a queue; thread target.
+    """
+    results.put((api, _provider_fetch(api, symbols, fields)))
+
+
+def _start_provider(results, api, symbols, fields):
+    """Run _provider_fetch() in a daemon thread.
+
+    Args:
+        results: Queue receiving the (api, quotes) tuple.
+        api: Financial data API; 'google' or 'yahoo'.
+        symbols: List of stock symbols.
+        fields: List of tag names.
+    """
+    thread = threading.Thread(target=_run_provider,
+                              args=(results, api, symbols, fields))
+    thread.daemon = True
+    thread.start()
+
+
+def _hedged_fetch(symbols, fields, apis, hedge_after):
+    """Get quotes, asking the next API if the current one is slow.
+
+    The first API is asked right away.  The next API is asked when no
+    answer has arrived hedge_after seconds after the previous request
+    (a hedged request), or as soon as the previous request fails.  The
+    first non-empty answer wins; slower requests finish in the
+    background.
+
+    Args:
+        symbols: List of stock symbols.
+        fields: List of tag names.
+        apis: APIs to ask, in order of preference.
+        hedge_after: Seconds to wait before asking the next API.
+
+    Returns:
+        (api, quotes) tuple; (None, {}) if every API failed.
+    """
+    results = Queue()
+    _start_provider(results, apis[0], symbols, fields)
+    launched = 1
+    pending = 1
+    while pending:
+        if launched < len(apis):
+            timeout = hedge_after
+        else:
+            timeout = None
+        try:
+            api, quotes = results.get(timeout=timeout)
+        except Empty:
+            quotes = None
+            _count('hedges')
+        else:
+            pending -= 1
+            if quotes:
+                return api, quotes
+        if launched < len(apis):
+            _start_provider(results, apis[launched], symbols, fields)
+            launched += 1
+            pending += 1
+    return None, {}
+
+
+def _failover_fetch(symbols, fields, apis, hedge_after):
+    """Get quotes for one batch, failing over between APIs.
+
+    Symbols the preferred API did not return (because it failed, was
+    slow, or just lacks them) are asked from the next API.
+
+    Args:
+        symbols: List of stock symbols.
+        fields: List of tag names.
+        apis: APIs to ask, in order of preference.
+        hedge_after: Seconds to wait before sending a hedged request to
+            the next API; None to only fail over on errors.
+
+    Returns:
+        Dictionary of symbols with dictionary of tag values.
+    """
+    apis = list(apis)
+    quotes = {}
+    asked = False
+    if hedge_after is not None:
+        api, quotes = _hedged_fetch(symbols, fields, apis, hedge_after)
+        if api is not None:
+            apis.remove(api)
+        asked = True
+    for api in apis:
+        missing = [symbol for symbol in symbols
+                   if _symbol_key(symbol) not in quotes]
+        if not missing:
+            break
+        if asked:
+            _count('failovers')
+        quotes.update(_provider_fetch(api, missing, fields))
+        asked = True
+    return quotes
+
+
+def get_quotes(symbols, fields=COMMON_TAGS, apis=APIS, hedge_after=None,
+               batch_size=None, max_workers=None):
+    """Get quote data from whichever API answers, per batch.
+
+    Unlike get_all(), this is not pinned to one API: each batch is
+    asked from the first API in apis, and symbols it cannot deliver are
+    asked from the next one.  With hedge_after, a slow API is also
+    raced against the next one.  Only tag names both APIs provide (see
+    COMMON_TAGS) can be expected from either.
+
+    Args:
+        symbols: Stock symbol or, confusingly, list of stock symbols.
+        fields: Tag names to get; defaults to COMMON_TAGS.
+        apis: APIs to use, in order of preference.
+        hedge_after: Seconds to wait for an API before also asking the
+            next one; None to only fail over on errors.
+        batch_size: Maximum number of symbols per request; defaults to
+            the smallest of the apis' BATCH_SIZES.
+        max_workers: Maximum number of concurrent batches; defaults to
+            DEFAULT_MAX_WORKERS.
+
+    Returns:
+        Dictionary of symbols with dictionary of tag values requested.
+    """
+    if isinstance(symbols, str):
+        symbols = [symbols]
+    if batch_size is None:
+        batch_size = min(BATCH_SIZES[api] for api in apis)
+    fetch = partial(_failover_fetch, fields=list(fields), apis=list(apis),
+                    hedge_after=hedge_after)
+    batches = _chunk_symbols(list(symbols), batch_size)
+    return _fetch_batches(fetch, batches, max_workers)
+
+
+def parse_number(value):
+    """Convert a quote value string to a float.
+
+    Args:
+        value: Quote value; e.g., '96.81', '+0.01', '2.85%', '1,234',
+            '45.3M', '1.2B', or 'N/A'.
+
+    Returns:
+        Float value; NaN for missing values ('N/A', etc.), or None if
+        the value is not a number (e.g., a company name).
+    """
+    value = value.strip().replace(',', '').rstrip('%')
+    if value in MISSING_VALUES:
+        return float('nan')
+    scale = NUMBER_SUFFIXES.get(value[-1:].upper())
+    if scale is not None:
+        value = value[:-1]
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    if scale is not None:
+        number *= scale
+    return number
+
+
+def _column(tag_name, values):
+    """Convert a list of quote value strings to a NumPy array.
+
+    Args:
+        tag_name: Tag name; see INTEGER_TAGS.
+        values: List of quote value strings.
+
+    Returns:
+        float64 (or int64) array if all values are numbers or missing,
+        otherwise an object array of the original strings.
+    """
+    try:
+        # Fast path: plain numbers are converted by NumPy in bulk.
+        column = numpy.array(values, dtype=numpy.float64)
+    except ValueError:
+        numbers = [parse_number(value) for value in values]
+        if None in numbers:
+            return numpy.array(values, dtype=object)
+        column = numpy.array(numbers, dtype=numpy.float64)
+    if tag_name in INTEGER_TAGS and numpy.isfinite(column).all():
+        column = column.astype(numpy.int64)
+    return column
+
+
+class QuoteTable(object):
+    """Columnar quote data: one typed NumPy array per tag name.
+
+    Attributes:
+        symbols: List of symbols; row order of every column.
+        symbol_index: Dictionary of symbol to row index.
+        columns: Dictionary of tag name to NumPy array.
+    """
+
+    def __init__(self, symbols, columns):
+        """Set up the table.
+
+        Args:
+            symbols: List of symbols, in row order.
+            columns: Dictionary of tag name to NumPy array.
+        """
+        self.symbols = symbols
+        self.symbol_index = dict((symbol, index)
+                                 for index, symbol in enumerate(symbols))
+        self.columns = columns
+
+    @classmethod
+    def from_quotes(cls, quotes):
+        """Build a table from get_all() style dictionaries.
+
+        Args:
+            quotes: Dictionary of symbols with dictionary of tag values.
+
+        Returns:
+            QuoteTable instance; tags a symbol lacks are NaN (or '').
+        """
+        if numpy is None:
+            raise ImportError('numpy is required for columnar results')
+        symbols = list(quotes)
+        tag_names = set()
+        for quote in quotes.values():
+            tag_names.update(quote)
+        columns = {}
+        for tag_name in sorted(tag_names):
+            values = [quotes[symbol].get(tag_name, '') for symbol in symbols]
+            columns[tag_name] = _column(tag_name, values)
+        return cls(symbols, columns)
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def __getitem__(self, tag_name):
+        return self.columns[tag_name]
+
+    def __contains__(self, tag_name):
+        return tag_name in self.columns
+
+    def row(self, symbol):
+        """Get the values for a single symbol.
+
+        Args:
+            symbol: Symbol, as in self.symbols.
+
+        Returns:
+            Dictionary of tag name to value.
+        """
+        index = self.symbol_index[symbol]
+        return dict((tag_name, column[index])
+                    for tag_name, column in self.columns.items())
 
 
 def parse_symbol_file(filepath, fapi=None):
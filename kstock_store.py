@@ -0,0 +1,294 @@
+"""Store kstock quote data on disk.
+
+QuoteHistory keeps a time series of polls in append-only, fixed-width
+column files that are memory-mapped for reading.
+
+Requires: NumPy
+"""
+__author__ = 'Kevin (penniesfromkevin at gmail)'
+__copyright__ = 'Copyright (c) 2014, Kevin'
+__version__ = '0.1.0'
+__license__ = 'MIT license'
+
+import json
+import logging
+import os
+import time
+
+import numpy
+
+import kstock
+
+# Maximum number of symbols a new history can hold.
+DEFAULT_CAPACITY = 8192
+HISTORY_VERSION = 1
+META_FILE = 'meta.json'
+SYMBOLS_FILE = 'symbols.txt'
+TIMESTAMPS_FILE = 'timestamps.f8'
+COLUMN_SUFFIX = '.f8'
+
+LOGGER = logging.getLogger()
+
+
+class QuoteHistory(object):
+    """Append-only, on-disk time series of numeric quote values.
+
+    Layout of the history directory:
+        meta.json        capacity (row width) and format version
+        symbols.txt      symbol dictionary; line N is column N
+        timestamps.f8    float64 poll time per row (the row index)
+        <tag_name>.f8    float64 rows of `capacity` values per poll
+
+    Each append() adds one row to every column file, with NaN for
+    missing values, and then one timestamp; the timestamp count is the
+    number of complete rows.  Reads memory-map the files, so query()
+    returns views into the files rather than copies.
+
+    Only one process should append to a history at a time.
+    """
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY, tags=None):
+        """Open or create a history.
+
+        Args:
+            path: History directory; created if missing.
+            capacity: Maximum number of symbols, for a new history.
+            tags: Tag names to store; by default, every tag with a
+                numeric value is stored.
+        """
+        self.path = path
+        self.tags = set(tags) if tags else None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as file_handle:
+                meta = json.load(file_handle)
+        else:
+            meta = {'capacity': capacity, 'version': HISTORY_VERSION}
+            with open(meta_path, 'w') as file_handle:
+                json.dump(meta, file_handle)
+        self.capacity = meta['capacity']
+        self.symbols = []
+        symbols_path = os.path.join(path, SYMBOLS_FILE)
+        if os.path.exists(symbols_path):
+            with open(symbols_path, 'r') as file_handle:
+                self.symbols = [line.rstrip('\n') for line in file_handle]
+        self.symbol_index = dict((symbol, index)
+                                 for index, symbol in enumerate(self.symbols))
+        self.columns = sorted(
+            name[:-len(COLUMN_SUFFIX)] for name in os.listdir(path)
+            if name.endswith(COLUMN_SUFFIX) and name != TIMESTAMPS_FILE)
+        self._writers = {}
+        self._maps = {}
+        self.rows = self._file_rows(TIMESTAMPS_FILE, 1)
+        self._truncate_partial_rows()
+
+    def _file_rows(self, name, width):
+        """Count the complete rows in a file.
+
+        Args:
+            name: File name in the history directory.
+            width: Number of float64 values per row.
+
+        Returns:
+            Number of rows.
+        """
+        file_path = os.path.join(self.path, name)
+        if not os.path.exists(file_path):
+            return 0
+        return os.path.getsize(file_path) // (8 * width)
+
+    def _truncate_partial_rows(self):
+        """Drop column rows written after the last complete timestamp.
+
+        An append() interrupted part way leaves some column files a row
+        ahead of the timestamps; trim them so rows line up again.
+        """
+        for tag_name in self.columns:
+            name = tag_name + COLUMN_SUFFIX
+            if self._file_rows(name, self.capacity) > self.rows:
+                LOGGER.warning('QuoteHistory: trimming partial rows in %s',
+                               name)
+                with open(os.path.join(self.path, name), 'r+b') as handle:
+                    handle.truncate(self.rows * self.capacity * 8)
+
+    def _writer(self, name):
+        """Get the append handle for a file, opening it if needed.
+        """
+        handle = self._writers.get(name)
+        if handle is None:
+            handle = open(os.path.join(self.path, name), 'ab')
+            self._writers[name] = handle
+        return handle
+
+    def _add_symbols(self, symbols):
+        """Add new symbols to the symbol dictionary.
+
+        Args:
+            symbols: Symbols not yet in the dictionary.
+
+        Raises:
+            ValueError: The history is full.
+        """
+        if len(self.symbols) + len(symbols) > self.capacity:
+            raise ValueError('QuoteHistory %s is full (%d symbols)'
+                             % (self.path, self.capacity))
+        with open(os.path.join(self.path, SYMBOLS_FILE), 'a') as handle:
+            for symbol in symbols:
+                handle.write('%s\n' % symbol)
+                self.symbol_index[symbol] = len(self.symbols)
+                self.symbols.append(symbol)
+
+    def _add_column(self, tag_name):
+        """Add a column file, back-filled with NaN for earlier rows.
+
+        Args:
+            tag_name: Tag name.
+        """
+        handle = self._writer(tag_name + COLUMN_SUFFIX)
+        empty = numpy.full(self.capacity, numpy.nan)
+        for _ in range(self.rows):
+            empty.tofile(handle)
+        self.columns.append(tag_name)
+        self.columns.sort()
+
+    def append(self, quotes, timestamp=None):
+        """Append one poll result.
+
+        Args:
+            quotes: Dictionary of symbols with dictionary of tag values,
+                as returned by kstock.get_all(), or a kstock.QuoteTable.
+            timestamp: Poll time, in seconds since the epoch; defaults
+                to now.  Must not be earlier than the last timestamp.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if self.rows and timestamp < self.last_timestamp():
+            raise ValueError('QuoteHistory timestamps must not decrease')
+        if isinstance(quotes, kstock.QuoteTable):
+            table = quotes
+        else:
+            table = kstock.QuoteTable.from_quotes(quotes)
+        new_symbols = [symbol for symbol in table.symbols
+                       if symbol not in self.symbol_index]
+        if new_symbols:
+            self._add_symbols(new_symbols)
+        indices = numpy.array([self.symbol_index[symbol]
+                               for symbol in table.symbols], dtype=numpy.intp)
+        rows = {}
+        for tag_name, column in table.columns.items():
+            if self.tags is not None and tag_name not in self.tags:
+                continue
+            if column.dtype == object:
+                continue
+            row = numpy.full(self.capacity, numpy.nan)
+            row[indices] = column
+            rows[tag_name] = row
+        for tag_name in rows:
+            if tag_name not in self.columns:
+                self._add_column(tag_name)
+        empty = None
+        for tag_name in self.columns:
+            row = rows.get(tag_name)
+            if row is None:
+                if empty is None:
+                    empty = numpy.full(self.capacity, numpy.nan)
+                row = empty
+            handle = self._writer(tag_name + COLUMN_SUFFIX)
+            row.tofile(handle)
+            handle.flush()
+        handle = self._writer(TIMESTAMPS_FILE)
+        numpy.array([timestamp], dtype=numpy.float64).tofile(handle)
+        handle.flush()
+        self.rows += 1
+
+    def _map(self, name, width):
+        """Memory-map the complete rows of a file.
+
+        Maps are cached and re-created when rows have been appended.
+
+        Args:
+            name: File name in the history directory.
+            width: Number of float64 values per row (1 for timestamps).
+
+        Returns:
+            Read-only NumPy memmap of shape (rows,) or (rows, width).
+        """
+        cached = self._maps.get(name)
+        if cached is not None and cached[0] == self.rows:
+            return cached[1]
+        if self.rows:
+            shape = (self.rows,) if width == 1 else (self.rows, width)
+            mapped = numpy.memmap(os.path.join(self.path, name),
+                                  dtype=numpy.float64, mode='r', shape=shape)
+        else:
+            mapped = numpy.empty((0,) if width == 1 else (0, width))
+        self._maps[name] = (self.rows, mapped)
+        return mapped
+
+    def timestamps(self):
+        """Get the timestamp index.
+
+        Returns:
+            Read-only float64 array; one poll time per row.
+        """
+        return self._map(TIMESTAMPS_FILE, 1)
+
+    def last_timestamp(self):
+        """Get the time of the last poll appended.
+
+        Returns:
+            Timestamp, or None if the history is empty.
+        """
+        if not self.rows:
+            return None
+        return float(self.timestamps()[-1])
+
+    def column(self, tag_name):
+        """Get all values of a tag.
+
+        Args:
+            tag_name: Tag name.
+
+        Returns:
+            Read-only float64 array of shape (rows, capacity); column N
+            belongs to self.symbols[N].
+        """
+        if tag_name not in self.columns:
+            raise KeyError(tag_name)
+        return self._map(tag_name + COLUMN_SUFFIX, self.capacity)
+
+    def query(self, symbol, tag_name, start=None, end=None):
+        """Get the values of one symbol and tag over a time range.
+
+        The returned arrays are views of the memory-mapped files; no
+        data is copied.
+
+        Args:
+            symbol: Symbol, as in the appended quotes.
+            tag_name: Tag name.
+            start: Earliest poll time to include; default: first.
+            end: Latest poll time to include; default: last.
+
+        Returns:
+            (timestamps, values) tuple of float64 arrays.
+        """
+        index = self.symbol_index[symbol]
+        values = self.column(tag_name)
+        timestamps = self.timestamps()
+        first = 0
+        last = self.rows
+        if start is not None:
+            first = int(numpy.searchsorted(timestamps, start, 'left'))
+        if end is not None:
+            last = int(numpy.searchsorted(timestamps, end, 'right'))
+        return timestamps[first:last], values[first:last, index]
+
+    def close(self):
+        """Close open file handles and memory maps.
+        """
+        for handle in self._writers.values():
+            handle.close()
+        self._writers = {}
+        self._maps = {}
@@ -6,11 +6,22 @@ __copyright__ = 'Copyright (c) 2014, Kevin.'
 __version__ = '0.1.1'
 
 import logging
+import multiprocessing
+import random
 import socket
 import sys
+import threading
 import time
 
 from argparse import ArgumentParser
+from collections import deque
+
+try:
+    # py3
+    from queue import Empty
+except ImportError:
+    # py2
+    from Queue import Empty
 
 import kstock
 
@@ -20,15 +31,41 @@ DEFAULT_PORT = 2878
 DEFAULT_DELAY = 10 #seconds
 DEFAULT_COUNT = -1
 DEFAULT_ERRORS = 10
+DEFAULT_BACKOFF_MAX = 300 #seconds
+
+# Tag names emitted per API; only these are fetched.
+DEFAULT_PARAMS = {
+        'google': 'last_trade_price,after_hours_price',
+        'yahoo': 'revenue,short_ratio',
+        }
+
+# MetricSender defaults.
+DEFAULT_BATCH_LINES = 500
+DEFAULT_BUFFER_LINES = 10000
+DEFAULT_FLUSH_INTERVAL = 1 #seconds
+DEFAULT_RECONNECT_MAX = 60 #seconds
+BUFFER_POLICIES = ('drop', 'block')
+MAX_DATAGRAM = 1400 #bytes
+
+# Unchanged values are re-sent after this many polls with --delta.
+DEFAULT_HEARTBEAT = 30
+
+# Worker processes; see main_workers().
+DEFAULT_WORKERS = 0
+DEFAULT_WORKER_TIMEOUT = 300 #seconds
+WORKER_QUEUE_SIZE = 1000
 
 LOG_LEVELS = ('CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG')
 DEFAULT_LOG_LEVEL = LOG_LEVELS[3]
 LOGGER = logging.getLogger()
 
 
-def parse_args():
+def parse_args(argv=None):
     """Parse user arguments and return as parser object.
 
+    Args:
+        argv: Argument list; default: sys.argv[1:].
+
     Returns:
         Parser object with arguments as attributes.
     """
@@ -44,17 +81,58 @@ def parse_args():
             help='Maximum number of socket errors allowed before quitting.')
     parser.add_argument('-c', '--count', default=DEFAULT_COUNT, type=int,
             help='Number of iterations; negative for infinite.')
+    parser.add_argument('-a', '--fixed_rate', action='store_true',
+            help='Poll each API concurrently on a fixed-rate clock.')
+    parser.add_argument('-i', '--intervals', default='',
+            help='Comma-separated api=seconds poll intervals for '
+                 '--fixed_rate, e.g., "google=5,yahoo=60"; APIs not '
+                 'listed use --delay.')
+    parser.add_argument('-w', '--workers', default=DEFAULT_WORKERS, type=int,
+            help='Shard symbols across this many worker processes.')
+    parser.add_argument('--worker_timeout', default=DEFAULT_WORKER_TIMEOUT,
+            type=int,
+            help='Restart a worker not heard from for this many seconds.')
+    parser.add_argument('-b', '--backoff_max', default=DEFAULT_BACKOFF_MAX,
+            type=int,
+            help='Maximum delay after failed polls with --fixed_rate, '
+                 'in seconds.')
+
+    for api in kstock.APIS:
+        parser.add_argument('--%s_params' % api, default=DEFAULT_PARAMS[api],
+                help='Comma-separated %s tag names to fetch and emit.' % api)
 
     parser.add_argument('-x', '--transmit', action='store_true',
             help='Send points to host for real.')
+    parser.add_argument('-z', '--delta', action='store_true',
+            help='Only emit values that changed since they were last '
+                 'emitted.')
+    parser.add_argument('--heartbeat', default=DEFAULT_HEARTBEAT, type=int,
+            help='With --delta, re-send unchanged values after this many '
+                 'polls.')
+    parser.add_argument('--epsilon', default='',
+            help='With --delta, comma-separated param=change pairs, '
+                 'e.g., "last_trade_price=0.01"; smaller changes are not '
+                 'emitted.')
     parser.add_argument('-s', '--host', default=DEFAULT_HOST,
             help='Host IP of machine running agent.')
     parser.add_argument('-p', '--port', default=DEFAULT_PORT, type=int,
             help='Host port receiving data.')
+    parser.add_argument('-u', '--udp', action='store_true',
+            help='Send points over UDP instead of TCP.')
+    parser.add_argument('--batch_lines', default=DEFAULT_BATCH_LINES,
+            type=int, help='Maximum number of lines sent at once.')
+    parser.add_argument('--buffer_lines', default=DEFAULT_BUFFER_LINES,
+            type=int, help='Maximum number of lines waiting to be sent.')
+    parser.add_argument('--buffer_policy', choices=BUFFER_POLICIES,
+            default=BUFFER_POLICIES[0],
+            help='What to do with new lines when the buffer is full.')
+
+    parser.add_argument('-I', '--instrument', action='store_true',
+            help='Emit kstock request, parse and transform statistics.')
 
     parser.add_argument('-L', '--loglevel', choices=LOG_LEVELS,
             default=DEFAULT_LOG_LEVEL, help='Set the logging level.')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 
@@ -68,12 +146,293 @@ def transmit_line(host, port, line):
     """
     sock = socket.socket()
     sock.connect((host, port))
-    sock.sendall('%s\n' % line)
+    sock.sendall(('%s\n' % line).encode())
     sock.close()
 
 
-def main():
-    """Main script.
+class MetricSender(object):
+    """Buffer metric lines and send them in batches over one connection.
+
+    Lines are queued by send() and written by a background thread, in
+    batches of up to batch_lines, over a persistent TCP connection (or
+    as UDP datagrams).  If the connection fails, the batch is kept and
+    the sender reconnects with exponential backoff.  When buffer_lines
+    lines are waiting, new lines are dropped or send() blocks,
+    depending on policy.
+    """
+
+    def __init__(self, host, port, udp=False,
+            batch_lines=DEFAULT_BATCH_LINES,
+            buffer_lines=DEFAULT_BUFFER_LINES, policy=BUFFER_POLICIES[0],
+            flush_interval=DEFAULT_FLUSH_INTERVAL,
+            reconnect_max=DEFAULT_RECONNECT_MAX):
+        """Set up the sender and start its thread.
+
+        Args:
+            host: Host IP.
+            port: Host port.
+            udp: If True, send datagrams instead of using TCP.
+            batch_lines: Maximum number of lines sent at once.
+            buffer_lines: Maximum number of lines waiting to be sent.
+            policy: 'drop' or 'block'; see BUFFER_POLICIES.
+            flush_interval: Maximum seconds a line waits for a batch to
+                fill up.
+            reconnect_max: Maximum seconds between reconnect attempts.
+        """
+        self.address = (host, port)
+        self.udp = udp
+        self.batch_lines = batch_lines
+        self.buffer_lines = buffer_lines
+        self.policy = policy
+        self.flush_interval = flush_interval
+        self.reconnect_max = reconnect_max
+        self.sent = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self._buffer = deque()
+        self._closing = False
+        self._sock = None
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, line):
+        """Queue a metric line.
+
+        Args:
+            line: Metric line to send, in Graphite format.
+
+        Returns:
+            True if the line was queued, False if it was dropped.
+        """
+        with self._condition:
+            while len(self._buffer) >= self.buffer_lines:
+                if self.policy == 'drop' or self._closing:
+                    self.dropped += 1
+                    return False
+                self._condition.wait()
+            self._buffer.append(line)
+            if len(self._buffer) >= self.batch_lines:
+                self._condition.notify_all()
+        return True
+
+    def close(self, timeout=None):
+        """Send the lines still buffered and close the connection.
+
+        Args:
+            timeout: Maximum seconds to wait for the buffer to drain.
+        """
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        self._disconnect()
+
+    def _connect(self):
+        """Open the socket, if it is not open yet.
+        """
+        if self._sock is None:
+            if self.udp:
+                self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            else:
+                self._sock = socket.create_connection(self.address)
+
+    def _disconnect(self):
+        """Close the socket, if it is open.
+        """
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _write(self, lines):
+        """Write a batch of lines to the socket.
+
+        Args:
+            lines: List of metric lines.
+        """
+        self._connect()
+        if self.udp:
+            datagram = []
+            size = 0
+            for line in lines:
+                data = ('%s\n' % line).encode()
+                if datagram and size + len(data) > MAX_DATAGRAM:
+                    self._sock.sendto(b''.join(datagram), self.address)
+                    datagram = []
+                    size = 0
+                datagram.append(data)
+                size += len(data)
+            if datagram:
+                self._sock.sendto(b''.join(datagram), self.address)
+        else:
+            data = ''.join('%s\n' % line for line in lines)
+            self._sock.sendall(data.encode())
+
+    def _take_batch(self):
+        """Wait for a full batch, the flush interval, or close().
+
+        Returns:
+            List of lines; empty once closing and the buffer is empty.
+        """
+        with self._condition:
+            deadline = time.time() + self.flush_interval
+            while (len(self._buffer) < self.batch_lines
+                    and not self._closing):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            count = min(len(self._buffer), self.batch_lines)
+            lines = [self._buffer.popleft() for _ in range(count)]
+            self._condition.notify_all()
+        return lines
+
+    def _run(self):
+        """Send batches until closed; runs in the sender thread.
+        """
+        backoff = 0
+        while True:
+            lines = self._take_batch()
+            if not lines:
+                if self._closing:
+                    break
+                continue
+            try:
+                self._write(lines)
+            except socket.error as err:
+                self._disconnect()
+                self.reconnects += 1
+                with self._condition:
+                    # Put the batch back, ahead of newer lines.
+                    self._buffer.extendleft(reversed(lines))
+                    if self._closing:
+                        LOGGER.error('MetricSender: giving up on %d lines: '
+                                '%s', len(self._buffer), err)
+                        self.dropped += len(self._buffer)
+                        self._buffer.clear()
+                        self._condition.notify_all()
+                        break
+                backoff = min(max(backoff * 2, 1), self.reconnect_max)
+                LOGGER.error('MetricSender: %s; retrying in %d seconds',
+                        err, backoff)
+                with self._condition:
+                    self._condition.wait(backoff)
+            else:
+                self.sent += len(lines)
+                backoff = 0
+
+
+class DeltaFilter(object):
+    """Suppress metric values that have not changed since last emitted.
+
+    A value counts as changed if it differs from the last emitted value
+    by more than the epsilon for its param (numbers) or at all (other
+    strings).  Unchanged values are still emitted every heartbeat polls.
+    """
+
+    def __init__(self, heartbeat=DEFAULT_HEARTBEAT, epsilons=None):
+        """Set up with no values emitted yet.
+
+        Args:
+            heartbeat: Number of polls after which an unchanged value
+                is emitted anyway.
+            epsilons: Dictionary of param to smallest change emitted.
+        """
+        self.heartbeat = heartbeat
+        self.epsilons = epsilons or {}
+        self.suppressed = 0
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def _differs(self, param, old, new):
+        """Check whether a value changed enough to be emitted.
+
+        Args:
+            param: Param name; see epsilons.
+            old: Last emitted value string.
+            new: New value string.
+
+        Returns:
+            True if the value changed by more than the epsilon.
+        """
+        try:
+            return abs(float(new) - float(old)) > self.epsilons.get(param, 0)
+        except ValueError:
+            return new != old
+
+    def changed(self, symbol, param, value):
+        """Check whether a value should be emitted, and track it.
+
+        Args:
+            symbol: Stock symbol.
+            param: Param name.
+            value: Value string.
+
+        Returns:
+            True if the value should be emitted.
+        """
+        key = (symbol, param)
+        with self._lock:
+            last = self._last.get(key)
+            if last is not None:
+                last_value, polls = last
+                if (polls + 1 < self.heartbeat
+                        and not self._differs(param, last_value, value)):
+                    self._last[key] = (last_value, polls + 1)
+                    self.suppressed += 1
+                    return False
+            self._last[key] = (value, 0)
+        return True
+
+
+# Set by main() when points are transmitted.
+SENDER = None
+# Set by main() with --delta.
+DELTAS = None
+# Set by main() with --instrument.
+STATS = None
+
+
+def parse_pairs(pairs):
+    """Parse a comma-separated string of name=number pairs.
+
+    Args:
+        pairs: String such as "google=5,yahoo=60".
+
+    Returns:
+        Dictionary of name to float.
+    """
+    values = {}
+    for item in pairs.split(','):
+        if '=' in item:
+            name, number = item.split('=', 1)
+            values[name.strip()] = float(number)
+    return values
+
+
+def parse_intervals(intervals, default):
+    """Parse per-API poll intervals.
+
+    Args:
+        intervals: Comma-separated api=seconds string.
+        default: Interval for APIs not listed, in seconds.
+
+    Returns:
+        Dictionary of API name to interval in seconds.
+    """
+    api_intervals = dict((api, default) for api in kstock.APIS)
+    api_intervals.update(parse_pairs(intervals))
+    return api_intervals
+
+
+def get_symbols():
+    """Get the symbols to poll, per API.
+
+    Returns:
+        Dictionary with, per API, the conformed symbols under the API
+        name and the parameters to emit under '<API>_params'; empty if
+        no symbols were specified.
     """
     if ARGS.tickers:
         symbols = ARGS.tickers.split(',')
@@ -81,35 +440,406 @@ def main():
         symbols = []
     if ARGS.filepath:
         symbols += kstock.parse_symbol_file(ARGS.filepath)
+    if not symbols:
+        return {}
+    forms = kstock.normalize_symbols(symbols)
+    g_symbols = [symbol.google for symbol in forms]
+    y_symbols = [symbol.yahoo for symbol in forms]
+    symbols = {
+            'google': g_symbols,
+            'yahoo': y_symbols,
+            }
+    for api in kstock.APIS:
+        params = getattr(ARGS, '%s_params' % api).split(',')
+        symbols['%s_params' % api] = [param.strip() for param in params
+                if param.strip()]
+    return symbols
+
+
+def format_quotes(quotes, params):
+    """Format quote parameters as metric lines.
+
+    Args:
+        quotes: Dictionary of symbols with dictionary of tag values.
+        params: Tag names to emit.
+
+    Returns:
+        List of (host, param, price, line) tuples.
+    """
+    points = []
+    for symbol in quotes:
+        LOGGER.debug(quotes[symbol])
+        host = symbol.strip('^.')
+        for param in params:
+            if param in quotes[symbol]:
+                price = quotes[symbol][param].strip()
+                line = "stock.%s %s host='%s'" % (param, price, host)
+                points.append((host, param, price, line))
+    return points
+
+
+def emit_points(points):
+    """Log and, optionally, transmit metric lines.
+
+    Args:
+        points: List of (host, param, price, line) tuples, as returned
+            by format_quotes().
+    """
+    for host, param, price, line in points:
+        if DELTAS is not None and not DELTAS.changed(host, param, price):
+            continue
+        LOGGER.info(line)
+        if SENDER is not None:
+            SENDER.send(line)
+
+
+def emit_quotes(quotes, params):
+    """Log and, optionally, transmit quote parameters.
+
+    Args:
+        quotes: Dictionary of symbols with dictionary of tag values.
+        params: Tag names to emit.
+    """
+    emit_points(format_quotes(quotes, params))
+
+
+def poll_api(symbols, api):
+    """Get and emit quotes from one API.
+
+    Args:
+        symbols: Dictionary from get_symbols().
+        api: API name.
+
+    Returns:
+        True if quotes were received, False if not, or None if the
+        poll was skipped because the API's circuit breaker is open.
+    """
+    if not kstock.provider_available(api):
+        LOGGER.warning('%s: circuit open; poll skipped', api)
+        if STATS is not None:
+            emit_stats(api)
+        return None
+    params = symbols['%s_params' % api]
+    quotes = kstock.get_all(symbols[api], api, fields=params)
+    if quotes:
+        emit_quotes(quotes, params)
+    if STATS is not None:
+        emit_stats(api)
+    return bool(quotes)
+
+
+def emit_stats(api):
+    """Log and, optionally, transmit kstock statistics, then reset them.
+
+    Rate limiter and circuit breaker state of the API is included as
+    kstock.<api>.provider.* lines.
+
+    Args:
+        api: API name, used as metric name prefix.
+    """
+    host = socket.gethostname()
+    lines = STATS.graphite_lines(host, 'kstock.%s' % api)
+    STATS.reset()
+    status = kstock.provider_status().get(api, {})
+    for name in sorted(status):
+        lines.append("kstock.%s.provider.%s %s host='%s'"
+                % (api, name, status[name], host))
+    for line in lines:
+        LOGGER.info(line)
+        if SENDER is not None:
+            SENDER.send(line)
+
+
+class PollState(object):
+    """Iteration count and error budget shared by polling threads.
+    """
+
+    def __init__(self, count, errors, error_max):
+        """Set up the state.
+
+        Args:
+            count: Number of successful polls left; negative for
+                infinite.
+            errors: Initial number of errors.
+            error_max: Number of errors at which polling stops.
+        """
+        self.count = count
+        self.errors = errors
+        self.error_max = error_max
+        self.stopped = threading.Event()
+        self._lock = threading.Lock()
+        if count == 0 or errors >= error_max:
+            self.stopped.set()
+
+    def success(self):
+        """Record a successful poll.
+        """
+        with self._lock:
+            if self.count > 0:
+                self.count -= 1
+            if self.errors > 0:
+                self.errors -= 1
+                LOGGER.info('---- Errors decremented: %d (%d) ----',
+                        self.errors, self.error_max)
+            LOGGER.info('---- %d left to go ----', self.count)
+            if self.count == 0:
+                self.stopped.set()
+
+    def failure(self):
+        """Record a failed poll.
+        """
+        with self._lock:
+            self.errors += 1
+            LOGGER.error('---- Errors: %d (%d) ----', self.errors,
+                    self.error_max)
+            if self.errors >= self.error_max:
+                LOGGER.info('Exiting due to maximum errors.')
+                self.stopped.set()
+
+
+def poll_fixed_rate(symbols, api, interval, state):
+    """Poll one API on a fixed-rate clock until the state is stopped.
+
+    Poll times are scheduled from the previous scheduled time rather
+    than from the end of the previous poll, so fetch latency does not
+    add to the cycle time; missed ticks are skipped.  After a failed
+    poll, the next one is delayed with exponential, jittered backoff.
+    Polls skipped while the API's circuit is open are not errors.
+
+    Args:
+        symbols: Dictionary from get_symbols().
+        api: API name.
+        interval: Seconds between polls.
+        state: PollState shared with the other polling threads.
+    """
+    next_time = time.time()
+    backoff = 0
+    while not state.stopped.is_set():
+        ok = poll_api(symbols, api)
+        if ok:
+            state.success()
+            backoff = 0
+            next_time += interval
+        elif ok is None:
+            next_time += interval
+        else:
+            state.failure()
+            backoff = min(max(backoff * 2, interval), ARGS.backoff_max)
+            next_time = time.time() + backoff * random.uniform(0.5, 1.0)
+        now = time.time()
+        if next_time < now:
+            missed = int((now - next_time) / interval) + 1
+            LOGGER.debug('%s: skipping %d missed polls', api, missed)
+            next_time += missed * interval
+        state.stopped.wait(next_time - now)
+
+
+def main_fixed_rate(symbols, errors):
+    """Poll all APIs concurrently, one thread per API.
+
+    Args:
+        symbols: Dictionary from get_symbols().
+        errors: Initial number of errors.
+
+    Returns:
+        Number of errors.
+    """
+    state = PollState(ARGS.count, errors, ARGS.error_max)
+    intervals = parse_intervals(ARGS.intervals, ARGS.delay)
+    threads = []
+    if not state.stopped.is_set():
+        for api in kstock.APIS:
+            thread = threading.Thread(target=poll_fixed_rate,
+                    args=(symbols, api, intervals[api], state))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+    while not state.stopped.is_set():
+        # Wake up now and then, so KeyboardInterrupt gets through.
+        state.stopped.wait(1)
+    for thread in threads:
+        thread.join()
+    return state.errors
+
+
+def shard_symbols(symbols, shards):
+    """Split the symbols to poll into shards.
+
+    Args:
+        symbols: Dictionary from get_symbols().
+        shards: Number of shards.
+
+    Returns:
+        List of dictionaries like symbols, each with every shards-th
+        symbol.
+    """
+    sharded = []
+    for index in range(shards):
+        shard = dict(symbols)
+        for api in kstock.APIS:
+            shard[api] = symbols[api][index::shards]
+        sharded.append(shard)
+    return sharded
+
+
+def poll_worker(worker_id, symbols, delay, count, queue):
+    """Poll a shard of symbols; runs in a worker process.
+
+    Results are put on the queue as ('result', worker_id, api, ok,
+    points) tuples, followed by ('done', worker_id) once count polls
+    succeeded; ok is None for polls skipped while the API's circuit is
+    open.
+
+    Args:
+        worker_id: Worker number.
+        symbols: Shard dictionary from shard_symbols().
+        delay: Delay between polls, in seconds.
+        count: Number of successful polls; negative for infinite.
+        queue: multiprocessing.Queue read by main_workers().
+    """
+    while count != 0:
+        for api in kstock.APIS:
+            if not kstock.provider_available(api):
+                queue.put(('result', worker_id, api, None, []))
+                continue
+            params = symbols['%s_params' % api]
+            quotes = kstock.get_all(symbols[api], api, fields=params)
+            points = format_quotes(quotes, params)
+            queue.put(('result', worker_id, api, bool(quotes), points))
+            if quotes and count > 0:
+                count -= 1
+                if count == 0:
+                    break
+        if count != 0:
+            time.sleep(delay)
+    queue.put(('done', worker_id))
+
+
+def start_worker(worker_id, shard, queue):
+    """Start a worker process for one shard.
+
+    Returns:
+        multiprocessing.Process instance.
+    """
+    process = multiprocessing.Process(target=poll_worker,
+            args=(worker_id, shard, ARGS.delay, ARGS.count, queue))
+    process.daemon = True
+    process.start()
+    return process
+
+
+def main_workers(symbols, errors):
+    """Poll shards of the symbols in worker processes.
+
+    Workers fetch and format their shard; this process merges their
+    results into one emission stream (--delta, --transmit) and keeps
+    the error budget.  A worker that crashes, or is not heard from for
+    --worker_timeout seconds, is restarted.
+
+    Args:
+        symbols: Dictionary from get_symbols().
+        errors: Initial number of errors.
+
+    Returns:
+        Number of errors.
+    """
+    state = PollState(DEFAULT_COUNT, errors, ARGS.error_max)
+    shards = shard_symbols(symbols, ARGS.workers)
+    queue = multiprocessing.Queue(WORKER_QUEUE_SIZE)
+    workers = {}
+    last_seen = {}
+    done = set()
+    if not state.stopped.is_set():
+        for worker_id, shard in enumerate(shards):
+            workers[worker_id] = start_worker(worker_id, shard, queue)
+            last_seen[worker_id] = time.time()
+    try:
+        while not state.stopped.is_set() and len(done) < len(workers):
+            try:
+                message = queue.get(timeout=1)
+            except Empty:
+                message = None
+            if message is not None:
+                worker_id = message[1]
+                last_seen[worker_id] = time.time()
+                if message[0] == 'done':
+                    done.add(worker_id)
+                elif message[3]:
+                    emit_points(message[4])
+                    state.success()
+                elif message[3] is not None:
+                    state.failure()
+            for worker_id, process in workers.items():
+                if worker_id in done:
+                    continue
+                if not process.is_alive():
+                    if process.exitcode == 0:
+                        done.add(worker_id)
+                        continue
+                    LOGGER.error('Worker %d died (exit code %s); restarting',
+                            worker_id, process.exitcode)
+                elif time.time() - last_seen[worker_id] > ARGS.worker_timeout:
+                    LOGGER.error('Worker %d not responding; restarting',
+                            worker_id)
+                    process.terminate()
+                    process.join()
+                else:
+                    continue
+                workers[worker_id] = start_worker(worker_id,
+                        shards[worker_id], queue)
+                last_seen[worker_id] = time.time()
+    finally:
+        for process in workers.values():
+            if process.is_alive():
+                process.terminate()
+            process.join()
+    return state.errors
+
+
+def main():
+    """Main script.
+    """
+    global SENDER, DELTAS, STATS
+    if ARGS.instrument:
+        STATS = kstock.StatsCollector()
+        kstock.add_hook(STATS)
+    if ARGS.delta:
+        DELTAS = DeltaFilter(ARGS.heartbeat, parse_pairs(ARGS.epsilon))
+    if ARGS.transmit:
+        SENDER = MetricSender(ARGS.host, ARGS.port, udp=ARGS.udp,
+                batch_lines=ARGS.batch_lines,
+                buffer_lines=ARGS.buffer_lines, policy=ARGS.buffer_policy)
+    try:
+        errors = poll()
+    finally:
+        if SENDER is not None:
+            SENDER.close(DEFAULT_RECONNECT_MAX)
+    return errors
+
+
+def poll():
+    """Poll the APIs until done.
+
+    Returns:
+        Number of errors.
+    """
+    symbols = get_symbols()
     if not symbols:
         LOGGER.error('No ticker symbols specified.')
         errors = ARGS.error_max
     else:
-        g_symbols = kstock.conform_symbols(symbols, 'google')
-        y_symbols = kstock.conform_symbols(symbols, 'yahoo')
-        symbols = {
-                'google': g_symbols,
-                'google_params': ['last_trade_price', 'after_hours_price'],
-                'yahoo': y_symbols,
-                'yahoo_params': ['revenue', 'short_ratio'],
-                }
         errors = 0
+    if ARGS.workers > 0:
+        return main_workers(symbols, errors)
+    if ARGS.fixed_rate:
+        return main_fixed_rate(symbols, errors)
     count = ARGS.count
     while count != 0 and errors < ARGS.error_max:
         for api in kstock.APIS:
-            quotes = kstock.get_all(symbols[api], api)
-            if quotes:
-                for symbol in quotes:
-                    LOGGER.debug(quotes[symbol])
-                    for param in symbols['%s_params' % api]:
-                        if param in quotes[symbol]:
-                            price = quotes[symbol][param].strip()
-                            symbol = symbol.strip('^.')
-                            line = "stock.%s %s host='%s'" % (param, price,
-                                    symbol)
-                            LOGGER.info(line)
-                            if ARGS.transmit:
-                                transmit_line(ARGS.host, ARGS.port, line)
+            ok = poll_api(symbols, api)
+            if ok is None:
+                continue
+            if ok:
                 if count > 0:
                     count -= 1
                 if errors > 0:
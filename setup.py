@@ -21,7 +21,7 @@ with open(os.path.join(this_dir, 'README.rst')) as fhandle:
 setup(
     name='kstock',
     version=__version__,
-    py_modules=['kstock'],
+    py_modules=['kstock', 'kstock_store'],
     author='Kevin',
     author_email='penniesfromkevin _at_ gmail.com',
     description='Get stock quote data from Google Finance and Yahoo Finance',
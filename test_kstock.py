@@ -13,8 +13,25 @@ __author__ = 'Kevin (penniesfromkevin at gmail)'
 __copyright__ = 'Copyright (c) 2014, Kevin'
 __version__ = '0.1.0'
 
+import gzip
+import io
+import json
+import re
+import threading
+import time
 import unittest
 
+try:
+    # py3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    # py2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
 import pep8
 from testscenarios import generate_scenarios, TestWithScenarios
 
@@ -26,12 +43,52 @@ COMPANIES = {
     }
 
 
+def fake_request(url):
+    """Stand-in for kstock._request() that answers from the URL alone.
+
+    Yahoo! values are '<symbol>-<tag>'; Google quotes carry the symbol
+    as 't' and a fixed 'l' (last trade price) of '1.00'.
+    """
+    query = parse_qs(urlparse(url).query)
+    if 'q' in query:
+        symbols = query['q'][0].split(',')
+        quotes = [{'t': symbol.split(':')[-1], 'l': '1.00'}
+                  for symbol in symbols]
+        return '// %s' % json.dumps(quotes)
+    symbols = query['s'][0].split()
+    tags = re.findall('[a-z][0-9]?', query['f'][0])
+    rows = [','.join('"%s-%s"' % (symbol, tag) for tag in tags)
+            for symbol in symbols]
+    return '\n'.join(rows)
+
+
+class FakeRequestMixin(object):
+    """Replace kstock._request() with fake_request() and record URLs."""
+
+    def setUp(self):
+        super(FakeRequestMixin, self).setUp()
+        self.urls = []
+        self.urls_lock = threading.Lock()
+        self.real_request = kstock._request
+        kstock._request = self.fake_request
+
+    def tearDown(self):
+        kstock._request = self.real_request
+        super(FakeRequestMixin, self).tearDown()
+
+    def fake_request(self, url):
+        with self.urls_lock:
+            self.urls.append(url)
+        return fake_request(url)
+
+
 class Pep8ConformanceTestCase(unittest.TestCase):
     """Test that all code conforms to PEP8!"""
 
     def test_pep8_conformance(self):
         self.pep8style = pep8.StyleGuide(show_source=True)
-        files = ('kstock.py', 'test_kstock.py')
+        files = ('kstock.py', 'test_kstock.py', 'kstock_store.py',
+                 'test_kstock_store.py', 'test_sample_point_creator.py')
         self.pep8style.check_files(files)
         self.assertEqual(self.pep8style.options.report.total_errors, 0)
 
@@ -94,5 +151,481 @@ class KStockTestCase(TestWithScenarios):
                         self.assertGreater(float(check_value), 0)
 
 
+class FakeQuoteHandler(BaseHTTPRequestHandler):
+    """Serve fake_request() responses over keep-alive HTTP/1.1."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        if self.path.startswith('/error'):
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = fake_request(self.path).encode()
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as gzip_file:
+                gzip_file.write(body)
+            body = buf.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeQuoteServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    connections = 0
+
+
+class FakeServerMixin(object):
+    """Run a FakeQuoteServer on localhost for the test."""
+
+    def setUp(self):
+        super(FakeServerMixin, self).setUp()
+        self.server = FakeQuoteServer(('127.0.0.1', 0), FakeQuoteHandler)
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(FakeServerMixin, self).tearDown()
+
+
+class ConnectionPoolTestCase(FakeServerMixin, unittest.TestCase):
+
+    def test_connection_reuse(self):
+        pool = kstock.ConnectionPool(maxsize=2, timeout=5)
+        url = '%s/d/quotes.csv?s=AAPL+GOOG&f=l1' % self.base_url
+        for _ in range(5):
+            status, _, body = pool.request(url)
+            self.assertEqual(status, 200)
+            self.assertEqual(body, b'"AAPL-l1"\n"GOOG-l1"')
+        self.assertEqual(self.server.connections, 1)
+        pool.clear()
+
+    def test_request_error(self):
+        real_pool = kstock.POOL
+        kstock.POOL = kstock.ConnectionPool()
+        try:
+            content = kstock._request('%s/error' % self.base_url)
+        finally:
+            kstock.POOL.clear()
+            kstock.POOL = real_pool
+        self.assertEqual(content, '')
+
+
+class StreamingTestCase(FakeServerMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(StreamingTestCase, self).setUp()
+        self.real_pool = kstock.POOL
+        self.real_url = kstock.Y_QUOTE_URL
+        kstock.POOL = kstock.ConnectionPool()
+        kstock.Y_QUOTE_URL = '%s/d/quotes.csv' % self.base_url
+
+    def tearDown(self):
+        kstock.POOL.clear()
+        kstock.POOL = self.real_pool
+        kstock.Y_QUOTE_URL = self.real_url
+        super(StreamingTestCase, self).tearDown()
+
+    def test_request_lines(self):
+        url = '%s/d/quotes.csv?s=AAPL+GOOG+MSFT&f=pn' % self.base_url
+        lines = list(kstock._request_lines(url, chunk_size=5))
+        self.assertEqual(lines, ['"AAPL-p","AAPL-n"', '"GOOG-p","GOOG-n"',
+                                 '"MSFT-p","MSFT-n"'])
+        list(kstock._request_lines(url))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_iter_tags(self):
+        symbols = ['S%03d' % index for index in range(50)]
+        quotes = kstock._y_iter_tags(symbols, ['previous_close', 'n'])
+        self.assertFalse(isinstance(quotes, (list, dict)))
+        quotes = list(quotes)
+        self.assertEqual([symbol for symbol, _ in quotes], symbols)
+        self.assertEqual(quotes[1][1], {'previous_close': 'S001-p',
+                                        'company_name': 'S001-n'})
+
+
+class ProviderGuardTestCase(FakeServerMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(ProviderGuardTestCase, self).setUp()
+        self.real_pool = kstock.POOL
+        kstock.POOL = kstock.ConnectionPool()
+
+    def tearDown(self):
+        kstock.POOL.clear()
+        kstock.POOL = self.real_pool
+        kstock.PROVIDERS.clear()
+        super(ProviderGuardTestCase, self).tearDown()
+
+    def test_rate_limiter(self):
+        limiter = kstock.RateLimiter(rate=50, burst=1)
+        start = time.time()
+        for _ in range(3):
+            limiter.acquire()
+        self.assertGreaterEqual(time.time() - start, 0.03)
+        limiter.throttled()
+        self.assertEqual(limiter.rate, 25)
+        for _ in range(20):
+            limiter.succeeded()
+        self.assertEqual(limiter.rate, 50)
+
+    def test_circuit_breaker(self):
+        breaker = kstock.CircuitBreaker(failure_threshold=2,
+                                        reset_timeout=0.05)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, kstock.CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertEqual(breaker.state, kstock.CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, kstock.CircuitBreaker.OPEN)
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, kstock.CircuitBreaker.CLOSED)
+        self.assertEqual((breaker.opens, breaker.rejected), (2, 2))
+
+    def test_request_circuit_open(self):
+        provider = self.base_url[len('http://'):]
+        guard = kstock.ProviderGuard(
+            breaker=kstock.CircuitBreaker(failure_threshold=2))
+        kstock.PROVIDERS[provider] = guard
+        for _ in range(2):
+            self.assertEqual(kstock._request('%s/error' % self.base_url), '')
+        self.assertFalse(kstock.provider_available(provider))
+        content = kstock._request('%s/d/quotes.csv?s=AAPL&f=l1'
+                                  % self.base_url)
+        self.assertEqual(content, '')
+        status = kstock.provider_status()[provider]
+        self.assertEqual(status['state'], 2)
+        self.assertEqual(status['rejected'], 1)
+        self.assertEqual(status['rate'], kstock.DEFAULT_RATE / 4)
+
+
+class BatchingTestCase(FakeRequestMixin, unittest.TestCase):
+
+    def test_chunk_symbols(self):
+        batches = kstock._chunk_symbols(list('ABCDEFG'), 3)
+        self.assertEqual(batches, [['A', 'B', 'C'], ['D', 'E', 'F'], ['G']])
+
+    def test_get_all_batches(self):
+        symbols = ['S%03d' % index for index in range(25)]
+        for fapi in kstock.APIS:
+            self.urls = []
+            all_info = kstock.get_all(symbols, fapi, batch_size=10,
+                                      max_workers=3)
+            self.assertEqual(len(self.urls), 3)
+            self.assertEqual(sorted(all_info), symbols)
+
+    def test_failed_batch_is_dropped(self):
+        def fetch(batch):
+            if 'B' in batch:
+                raise IOError('boom')
+            return dict((symbol, {}) for symbol in batch)
+        batches = [['A'], ['B'], ['C']]
+        symbol_dict = kstock._fetch_batches(fetch, batches, max_workers=2)
+        self.assertEqual(sorted(symbol_dict), ['A', 'C'])
+
+
+class FailoverTestCase(FakeRequestMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(FailoverTestCase, self).setUp()
+        self.down = set()
+        self.delays = {}
+
+    def fake_request(self, url):
+        if url.startswith(kstock.G_QUOTE_URL):
+            api = 'google'
+        else:
+            api = 'yahoo'
+        time.sleep(self.delays.get(api, 0))
+        if api in self.down:
+            raise IOError('%s is down' % api)
+        return super(FailoverTestCase, self).fake_request(url)
+
+    def test_common_tags(self):
+        self.assertIn('last_trade_price', kstock.COMMON_TAGS)
+        self.assertNotIn('previous_close', kstock.COMMON_TAGS)
+
+    def test_preferred_api(self):
+        quotes = kstock.get_quotes(['AAPL', 'GOOG'], ['last_trade_price'])
+        self.assertEqual(quotes['AAPL'], {'last_trade_price': '1.00'})
+        self.assertEqual(len(self.urls), 1)
+
+    def test_failover(self):
+        self.down.add('google')
+        quotes = kstock.get_quotes(['AAPL', 'NASDAQ:GOOG'],
+                                   ['last_trade_price'])
+        self.assertEqual(quotes, {'AAPL': {'last_trade_price': 'AAPL-l1'},
+                                  'GOOG': {'last_trade_price': 'GOOG-l1'}})
+
+    def test_hedged_request(self):
+        self.delays['google'] = 1
+        start = time.time()
+        quotes = kstock.get_quotes(['AAPL'], ['last_trade_price'],
+                                   hedge_after=0.05)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(quotes, {'AAPL': {'last_trade_price': 'AAPL-l1'}})
+
+    def test_all_down(self):
+        self.down.update(kstock.APIS)
+        self.assertEqual(kstock.get_quotes(['AAPL'], hedge_after=0.01), {})
+
+
+class QuoteTestCase(FakeRequestMixin, unittest.TestCase):
+
+    def test_lazy_parse(self):
+        layout = kstock._y_layout(('a', 'b', 'c'), raw_lines=True)
+        quote = kstock.Quote(layout, '"1,5",2')
+        self.assertIsNone(quote._row)
+        self.assertFalse(hasattr(quote, '__dict__'))
+        self.assertEqual(quote['a'], '1,5')
+        self.assertEqual(quote._row, ['1,5', '2', kstock._MISSING])
+        self.assertNotIn('c', quote)
+        self.assertEqual(quote, {'a': '1,5', 'b': '2'})
+
+    def test_dict_compatible(self):
+        layout = kstock._y_layout(('a', 'b'))
+        quote = kstock.Quote(layout, ['1', '2'])
+        copy = quote.copy()
+        quote['z'] = '26'
+        del quote['a']
+        self.assertEqual(dict(quote), {'b': '2', 'z': '26'})
+        self.assertEqual(len(quote), 2)
+        self.assertEqual(quote.get('a', 'none'), 'none')
+        self.assertRaises(KeyError, quote.__delitem__, 'a')
+        self.assertEqual(copy, {'a': '1', 'b': '2'})
+
+    def test_get_all_quotes(self):
+        quotes = kstock.get_all(['AAPL', 'GOOG'], 'yahoo')
+        quote = quotes['AAPL']
+        self.assertIsInstance(quote, kstock.Quote)
+        self.assertEqual(len(quote), len(kstock.Y_ALL_TAG_NAMES))
+        self.assertEqual(quote['volume'], 'AAPL-v')
+        quotes = kstock.get_all(['NASDAQ:AAPL'], 'google')
+        self.assertEqual(quotes, {'AAPL': {'last_trade_price': '1.00',
+                                           'company_name': 'AAPL'}})
+
+    def test_get_all_fields(self):
+        quotes = kstock.get_all(['AAPL'], 'yahoo',
+                                fields=['volume', 'after_hours_price'])
+        self.assertTrue(self.urls[-1].endswith('&f=v'))
+        self.assertEqual(quotes, {'AAPL': {'volume': 'AAPL-v'}})
+        quotes = kstock.get_all(['AAPL'], 'google',
+                                fields=['last_trade_price', 'volume'])
+        self.assertEqual(quotes, {'AAPL': {'last_trade_price': '1.00'}})
+
+
+class QuoteCacheTestCase(FakeRequestMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(QuoteCacheTestCase, self).setUp()
+        self.cache = kstock.QuoteCache(ttl=60, max_entries=100)
+        kstock.QUOTE_CACHE = self.cache
+
+    def tearDown(self):
+        kstock.QUOTE_CACHE = None
+        super(QuoteCacheTestCase, self).tearDown()
+
+    def test_lru_eviction(self):
+        cache = kstock.QuoteCache(ttl=60, max_entries=2)
+        cache.put(('yahoo', 'A', 'p'), '1')
+        cache.put(('yahoo', 'B', 'p'), '2')
+        self.assertEqual(cache.get(('yahoo', 'A', 'p')), '1')
+        cache.put(('yahoo', 'C', 'p'), '3')
+        self.assertIsNone(cache.get(('yahoo', 'B', 'p')))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_ttl_expiry(self):
+        cache = kstock.QuoteCache(ttl=-1)
+        cache.put(('yahoo', 'A', 'p'), '1')
+        self.assertIsNone(cache.get(('yahoo', 'A', 'p')))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_only_missing_fetched(self):
+        kstock._y_get_tags(['AAPL', 'GOOG'], ['previous_close'])
+        all_info = kstock._y_get_tags(['AAPL', 'MSFT'],
+                                      ['previous_close', 'volume'])
+        self.assertEqual(len(self.urls), 2)
+        query = parse_qs(urlparse(self.urls[1]).query)
+        self.assertEqual(query['s'], ['AAPL MSFT'])
+        self.assertEqual(all_info['AAPL']['previous_close'], 'AAPL-p')
+        self.assertEqual(all_info['MSFT']['volume'], 'MSFT-v')
+        kstock._y_get_tag(['MSFT'], 'pv')
+        self.assertEqual(len(self.urls), 2)
+
+    def test_google_cached(self):
+        first = kstock.get_all(['NASDAQ:AAPL', 'GOOG'], 'google')
+        second = kstock.get_all(['NASDAQ:AAPL', 'GOOG'], 'google')
+        self.assertEqual(sorted(first), ['AAPL', 'GOOG'])
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.urls), 1)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def test_overlapping_fetches_coalesce(self):
+        flights = kstock.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        fetched = []
+
+        def fetch(keys):
+            fetched.append(keys)
+            started.set()
+            release.wait(5)
+            return dict((key, key[0].lower()) for key in keys)
+
+        results = {}
+
+        def run(name, keys):
+            results[name] = flights.fetch('yahoo', keys, fetch)
+
+        threads = [
+            threading.Thread(target=run,
+                             args=('first', [('A', 'p'), ('B', 'p')])),
+            threading.Thread(target=run,
+                             args=('second', [('B', 'p'), ('C', 'p')])),
+            ]
+        threads[0].start()
+        started.wait(5)
+        threads[1].start()
+        while not flights.shared:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        second = results['second']
+        self.assertEqual(fetched, [[('A', 'p'), ('B', 'p')], [('C', 'p')]])
+        self.assertEqual(second, {('B', 'p'): 'b', ('C', 'p'): 'c'})
+        self.assertEqual(results['first'], {('A', 'p'): 'a', ('B', 'p'): 'b'})
+        self.assertEqual(flights.shared, 1)
+
+
+class InstrumentationTestCase(FakeRequestMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(InstrumentationTestCase, self).setUp()
+        self.stats = kstock.StatsCollector()
+        kstock.add_hook(self.stats)
+
+    def tearDown(self):
+        kstock.remove_hook(self.stats)
+        super(InstrumentationTestCase, self).tearDown()
+
+    def test_stages_and_counts(self):
+        kstock.get_all(['AAPL', 'GOOG', 'MSFT'], 'google')
+        kstock._y_get_tags(['AAPL'], ['previous_close'])
+        stats = self.stats.stats()
+        self.assertEqual(stats['symbols_per_request'], 4)
+        self.assertEqual(stats['parse.calls'], 2)
+        self.assertEqual(stats['transform.calls'], 2)
+        lines = self.stats.graphite_lines('box')
+        self.assertIn("kstock.symbols_per_request 4 host='box'", lines)
+        self.stats.reset()
+        self.assertEqual(self.stats.stats(), {})
+
+
+class TagRegistryTestCase(unittest.TestCase):
+
+    def test_reverse_tags(self):
+        for tags, tag_names in ((kstock.G_TAGS, kstock.G_TAG_NAMES),
+                                (kstock.Y_TAGS, kstock.Y_TAG_NAMES)):
+            for tag, tag_name in tag_names.items():
+                self.assertEqual(tags[tag_name], tag)
+        self.assertEqual(kstock.Y_TAG_NAMES['v'], 'more_info')
+
+    def test_tag_plan(self):
+        plan = kstock._y_tag_plan(['previous_close', 'n', 'zz'])
+        self.assertEqual(plan, (('previous_close', 'company_name', 'unknown'),
+                                ('p', 'n', 'zz')))
+        self.assertIs(kstock._y_tag_plan(('previous_close', 'n', 'zz')), plan)
+
+
+class SymbolFormsTestCase(unittest.TestCase):
+
+    def test_conform_symbols(self):
+        symbols = ['aapl', 'NASDAQ:BRCD', 'INDEXNASDAQ:.IXIC', '^SPXPM']
+        self.assertEqual(kstock.conform_symbols(symbols, 'google'),
+                         ['AAPL', 'NASDAQ:BRCD', 'INDEXNASDAQ:.IXIC',
+                          '.SPXPM'])
+        self.assertEqual(kstock.conform_symbols(symbols, 'yahoo'),
+                         ['AAPL', 'BRCD', '^IXIC', '^SPXPM'])
+
+    def test_round_trip(self):
+        forms = kstock.symbol_forms('indexnasdaq:.ixic')
+        self.assertEqual(forms, ('INDEXNASDAQ:.IXIC', 'INDEXNASDAQ:.IXIC',
+                                 '^IXIC'))
+        self.assertIs(kstock.symbol_forms(forms.google), forms)
+        self.assertEqual(kstock.normalize_symbols(['indexnasdaq:.ixic']),
+                         [forms])
+
+
+class ParseNumberTestCase(unittest.TestCase):
+
+    def test_parse_number(self):
+        test_inputs = (
+            ('96.81', 96.81),
+            ('+0.01', 0.01),
+            ('-2.38%', -2.38),
+            ('1,234.5', 1234.5),
+            ('45.3M', 45.3e6),
+            ('1.2B', 1.2e9),
+            ('Apple Inc.', None),
+            )
+        for value, number in test_inputs:
+            if number is None:
+                self.assertIsNone(kstock.parse_number(value))
+            else:
+                self.assertAlmostEqual(kstock.parse_number(value), number)
+        self.assertNotEqual(kstock.parse_number('N/A'),
+                            kstock.parse_number('N/A'))
+
+
+@unittest.skipIf(kstock.numpy is None, 'numpy is not installed')
+class QuoteTableTestCase(unittest.TestCase):
+
+    def test_from_quotes(self):
+        quotes = {
+            'AAPL': {'last_trade_price': '96.81', 'volume': '1200',
+                     'company_name': 'Apple Inc.', 'revenue': '182.8B'},
+            'GOOG': {'last_trade_price': 'N/A', 'volume': '900',
+                     'company_name': 'Google Inc.'},
+            }
+        table = kstock.QuoteTable.from_quotes(quotes)
+        aapl = table.symbol_index['AAPL']
+        goog = table.symbol_index['GOOG']
+        self.assertEqual(table['last_trade_price'].dtype, kstock.numpy.float64)
+        self.assertEqual(table['last_trade_price'][aapl], 96.81)
+        self.assertTrue(kstock.numpy.isnan(table['last_trade_price'][goog]))
+        self.assertEqual(table['volume'].dtype, kstock.numpy.int64)
+        self.assertEqual(table['revenue'][aapl], 182.8e9)
+        self.assertEqual(table['company_name'].dtype, object)
+        self.assertEqual(table.row('GOOG')['company_name'], 'Google Inc.')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Tests for kstock_store.
+
+Requires: NumPy
+"""
+__author__ = 'Kevin (penniesfromkevin at gmail)'
+__copyright__ = 'Copyright (c) 2014, Kevin'
+__version__ = '0.1.0'
+
+import shutil
+import tempfile
+import unittest
+
+try:
+    import numpy
+    import kstock_store
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class QuoteHistoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def append_polls(self, history):
+        for step in range(5):
+            quotes = {
+                'AAPL': {'last_trade_price': str(100 + step),
+                         'company_name': 'Apple Inc.'},
+                'GOOG': {'last_trade_price': str(500 + step)},
+                }
+            history.append(quotes, timestamp=1000 + step * 10)
+
+    def test_query_range(self):
+        history = kstock_store.QuoteHistory(self.path, capacity=4)
+        self.append_polls(history)
+        timestamps, values = history.query('AAPL', 'last_trade_price',
+                                           1010, 1030)
+        self.assertEqual(list(timestamps), [1010, 1020, 1030])
+        self.assertEqual(list(values), [101, 102, 103])
+        self.assertTrue(numpy.shares_memory(
+            values, history.column('last_trade_price')))
+        self.assertEqual(history.columns, ['last_trade_price'])
+        history.close()
+
+    def test_reopen_and_new_tag(self):
+        history = kstock_store.QuoteHistory(self.path, capacity=4)
+        self.append_polls(history)
+        history.close()
+        history = kstock_store.QuoteHistory(self.path)
+        self.assertEqual(history.rows, 5)
+        history.append({'MSFT': {'volume': '1,200'}}, timestamp=2000)
+        _, volumes = history.query('MSFT', 'volume')
+        self.assertEqual(len(volumes), 6)
+        self.assertTrue(numpy.isnan(volumes[:5]).all())
+        self.assertEqual(volumes[5], 1200)
+        _, prices = history.query('GOOG', 'last_trade_price', start=1040)
+        self.assertTrue(numpy.isnan(prices[-1]))
+        history.close()
+
+    def test_errors(self):
+        history = kstock_store.QuoteHistory(self.path, capacity=1)
+        history.append({'AAPL': {'volume': '1'}}, timestamp=10)
+        self.assertRaises(ValueError, history.append,
+                          {'AAPL': {'volume': '1'}}, 5)
+        self.assertRaises(ValueError, history.append,
+                          {'GOOG': {'volume': '1'}}, 20)
+        history.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
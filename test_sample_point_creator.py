@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+"""Tests for sample_point_creator.
+"""
+__author__ = 'Kevin (penniesfromkevin at gmail)'
+__copyright__ = 'Copyright (c) 2014, Kevin'
+__version__ = '0.1.0'
+
+import multiprocessing
+import socket
+import threading
+import time
+import unittest
+
+import kstock
+import sample_point_creator as spc
+
+# Python 2 always forks worker processes.
+START_METHOD = getattr(multiprocessing, 'get_start_method', lambda: 'fork')
+FORKED = START_METHOD() == 'fork'
+
+
+class FakeClock(object):
+    """Stand-in for the time and random modules; time only moves when
+    a poll or a wait moves it."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def uniform(self, low, high):
+        return high
+
+
+class FakeEvent(object):
+    """threading.Event whose wait() advances a FakeClock."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.flag = False
+
+    def is_set(self):
+        return self.flag
+
+    def set(self):
+        self.flag = True
+
+    def wait(self, timeout=None):
+        self.clock.now += max(timeout or 0, 0)
+        return self.flag
+
+
+def wait_for(condition, timeout=5):
+    """Poll condition() until it is true or timeout seconds pass."""
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class LineServer(object):
+    """Local TCP server collecting the lines it receives.
+
+    The socket is bound at once but only accepts connections after
+    listen(), so a sender can be started against a refusing port.
+    """
+
+    def __init__(self, listen=True):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.connections = 0
+        self.data = []
+        self.lock = threading.Lock()
+        if listen:
+            self.listen()
+
+    def listen(self):
+        self.sock.listen(5)
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    break
+                with self.lock:
+                    self.data.append(data)
+            conn.close()
+
+    @property
+    def lines(self):
+        with self.lock:
+            return b''.join(self.data).decode().splitlines()
+
+    def close(self):
+        self.sock.close()
+
+
+class PointCreatorMixin(object):
+    """Set sample_point_creator.ARGS and restore its globals."""
+
+    argv = []
+
+    def setUp(self):
+        super(PointCreatorMixin, self).setUp()
+        self.saved = dict((name, getattr(spc, name, None)) for name in (
+            'ARGS', 'poll_api', 'emit_points', 'time', 'random'))
+        spc.ARGS = spc.parse_args(self.argv)
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(spc, name, value)
+        super(PointCreatorMixin, self).tearDown()
+
+
+class FixedRateTestCase(PointCreatorMixin, unittest.TestCase):
+
+    argv = ['--backoff_max', '40']
+
+    def setUp(self):
+        super(FixedRateTestCase, self).setUp()
+        self.clock = FakeClock()
+        spc.time = self.clock
+        spc.random = self.clock
+        self.polls = []
+
+    def state(self, count, error_max):
+        state = spc.PollState(count, 0, error_max)
+        state.stopped = FakeEvent(self.clock)
+        return state
+
+    def test_missed_ticks_are_skipped(self):
+        def poll_api(symbols, api):
+            self.polls.append(self.clock.now)
+            if len(self.polls) == 1:
+                # A slow fetch, spanning two and a half intervals.
+                self.clock.now += 25
+            return True
+
+        spc.poll_api = poll_api
+        spc.poll_fixed_rate({}, 'google', 10, self.state(3, 10))
+        self.assertEqual(self.polls, [1000, 1030, 1040])
+
+    def test_backoff_is_capped(self):
+        def poll_api(symbols, api):
+            self.polls.append(self.clock.now)
+            return False
+
+        spc.poll_api = poll_api
+        state = self.state(-1, 5)
+        spc.poll_fixed_rate({}, 'google', 10, state)
+        # Backoff doubles from the interval up to --backoff_max.
+        self.assertEqual(self.polls, [1000, 1010, 1030, 1070, 1110])
+        self.assertEqual(state.errors, 5)
+
+    def test_skipped_polls_are_not_errors(self):
+        results = [None, None, True]
+
+        def poll_api(symbols, api):
+            self.polls.append(self.clock.now)
+            return results.pop(0)
+
+        spc.poll_api = poll_api
+        state = self.state(1, 1)
+        spc.poll_fixed_rate({}, 'google', 10, state)
+        self.assertEqual(self.polls, [1000, 1010, 1020])
+        self.assertEqual(state.errors, 0)
+
+
+class FixedRateThreadsTestCase(PointCreatorMixin, unittest.TestCase):
+
+    argv = ['--intervals', 'google=0.001,yahoo=0.001', '--count', '5',
+            '--error_max', '4', '--backoff_max', '0']
+
+    def setUp(self):
+        super(FixedRateThreadsTestCase, self).setUp()
+        self.results = {}
+
+    def poll_api(self, symbols, api):
+        return self.results[api]
+
+    def test_count_across_threads(self):
+        self.results = {'google': True, 'yahoo': True}
+        spc.poll_api = self.poll_api
+        self.assertEqual(spc.main_fixed_rate({}, 0), 0)
+
+    def test_error_max_across_threads(self):
+        self.results = {'google': False, 'yahoo': None}
+        spc.poll_api = self.poll_api
+        errors = spc.main_fixed_rate({}, 0)
+        self.assertGreaterEqual(errors, spc.ARGS.error_max)
+        self.assertLessEqual(errors, spc.ARGS.error_max + 1)
+
+    def test_poll_state(self):
+        state = spc.PollState(2, 1, 3)
+        state.success()
+        self.assertEqual((state.count, state.errors), (1, 0))
+        self.assertFalse(state.stopped.is_set())
+        state.success()
+        self.assertTrue(state.stopped.is_set())
+        state = spc.PollState(-1, 2, 3)
+        state.failure()
+        self.assertTrue(state.stopped.is_set())
+        self.assertTrue(spc.PollState(0, 0, 3).stopped.is_set())
+
+
+class MetricSenderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = None
+        self.sender = None
+
+    def tearDown(self):
+        if self.sender is not None:
+            self.sender.close(5)
+        if self.server is not None:
+            self.server.close()
+
+    def start(self, listen=True, **kwargs):
+        self.server = LineServer(listen)
+        self.sender = spc.MetricSender('127.0.0.1', self.server.port,
+                                       **kwargs)
+        return self.sender
+
+    def test_full_batch_is_sent_at_once(self):
+        sender = self.start(batch_lines=3, flush_interval=60)
+        lines = ['a 1', 'b 2', 'c 3', 'd 4']
+        for line in lines:
+            self.assertTrue(sender.send(line))
+        self.assertTrue(wait_for(lambda: len(self.server.lines) == 3))
+        self.assertTrue(wait_for(lambda: sender.sent == 3))
+        # The fourth line waits for the flush interval, or close().
+        time.sleep(0.1)
+        self.assertEqual(self.server.lines, lines[:3])
+        sender.close(5)
+        self.assertTrue(wait_for(lambda: self.server.lines == lines))
+        self.assertEqual(self.server.connections, 1)
+
+    def test_flush_interval(self):
+        sender = self.start(batch_lines=100, flush_interval=0.05)
+        sender.send('a 1')
+        self.assertTrue(wait_for(lambda: self.server.lines == ['a 1']))
+        self.assertTrue(wait_for(lambda: sender.sent == 1))
+
+    def test_udp_batch_is_one_datagram(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(receiver.close)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(5)
+        self.sender = spc.MetricSender(
+            '127.0.0.1', receiver.getsockname()[1], udp=True,
+            batch_lines=3, flush_interval=60)
+        for line in ('a 1', 'b 2', 'c 3'):
+            self.sender.send(line)
+        self.assertEqual(receiver.recv(spc.MAX_DATAGRAM),
+                         b'a 1\nb 2\nc 3\n')
+
+    def test_reconnect(self):
+        sender = self.start(listen=False, batch_lines=1, reconnect_max=1)
+        sender.send('a 1')
+        self.assertTrue(wait_for(lambda: sender.reconnects > 0))
+        self.server.listen()
+        sender.send('b 2')
+        # The failed line is retried first, after at most reconnect_max.
+        self.assertTrue(wait_for(
+            lambda: self.server.lines == ['a 1', 'b 2']))
+        self.assertTrue(wait_for(lambda: sender.sent == 2))
+        self.assertEqual(sender.dropped, 0)
+
+    def test_drop_policy(self):
+        sender = self.start(buffer_lines=2, batch_lines=100,
+                            flush_interval=60, policy='drop')
+        results = [sender.send('line %d' % number) for number in range(5)]
+        self.assertEqual(results, [True, True, False, False, False])
+        self.assertEqual(sender.dropped, 3)
+        sender.close(5)
+        self.assertTrue(wait_for(
+            lambda: self.server.lines == ['line 0', 'line 1']))
+
+    def test_block_policy(self):
+        sender = self.start(listen=False, buffer_lines=2, batch_lines=2,
+                            reconnect_max=1, policy='block')
+        lines = ['line %d' % number for number in range(6)]
+        thread = threading.Thread(target=lambda: [
+            sender.send(line) for line in lines])
+        thread.daemon = True
+        thread.start()
+        # Nothing can be sent, so send() blocks on the full buffer.
+        self.assertTrue(wait_for(lambda: sender.reconnects > 0))
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        self.server.listen()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(wait_for(lambda: self.server.lines == lines))
+        self.assertEqual(sender.dropped, 0)
+
+
+class DeltaFilterTestCase(unittest.TestCase):
+
+    def test_epsilon(self):
+        deltas = spc.DeltaFilter(heartbeat=100, epsilons={'price': 0.05})
+        values = ['10.00', '10.03', '10.06', '10.10', '10.10', 'N/A', 'N/A']
+        emitted = [deltas.changed('MSFT', 'price', value)
+                   for value in values]
+        # Changes are measured from the last value emitted, not seen.
+        self.assertEqual(emitted,
+                         [True, False, True, False, False, True, False])
+        self.assertEqual(deltas.suppressed, 4)
+        # Params without an epsilon are emitted on any change.
+        self.assertTrue(deltas.changed('MSFT', 'volume', '100'))
+        self.assertTrue(deltas.changed('MSFT', 'volume', '101'))
+
+    def test_heartbeat(self):
+        deltas = spc.DeltaFilter(heartbeat=3)
+        emitted = [deltas.changed('MSFT', 'price', '10') for _ in range(7)]
+        self.assertEqual(emitted,
+                         [True, False, False, True, False, False, True])
+        # Each symbol and param has its own heartbeat.
+        self.assertTrue(deltas.changed('IBM', 'price', '10'))
+
+
+def symbol_lists(symbols):
+    """Build a get_symbols() style dictionary, polling last prices."""
+    lists = {}
+    for api in kstock.APIS:
+        lists[api] = list(symbols)
+        lists['%s_params' % api] = ['last_trade_price']
+    return lists
+
+
+class WorkersTestCase(PointCreatorMixin, unittest.TestCase):
+
+    argv = ['--workers', '3', '--count', '2', '--delay', '0']
+
+    def test_shard_symbols(self):
+        symbols = symbol_lists('S%d' % number for number in range(10))
+        shards = spc.shard_symbols(symbols, 3)
+        self.assertEqual(len(shards), 3)
+        for api in kstock.APIS:
+            lists = [shard[api] for shard in shards]
+            merged = [symbol for symbol_list in lists
+                      for symbol in symbol_list]
+            self.assertEqual(sorted(merged), sorted(symbols[api]))
+            sizes = [len(symbol_list) for symbol_list in lists]
+            self.assertLessEqual(max(sizes) - min(sizes), 1)
+        for shard in shards:
+            self.assertEqual(shard['yahoo_params'], ['last_trade_price'])
+        # More shards than symbols leaves some empty.
+        shards = spc.shard_symbols(symbol_lists(['MSFT']), 2)
+        self.assertEqual([shard['google'] for shard in shards],
+                         [['MSFT'], []])
+
+    @unittest.skipUnless(FORKED, 'workers only see patches when forked')
+    def test_main_workers_merges_results(self):
+        symbols = symbol_lists(['MSFT', 'NASDAQ:GOOG', '^IXIC', 'AAPL',
+                                'IBM', 'ORCL', 'INTC'])
+        points = []
+
+        def get_all(symbol_list, api):
+            # Runs in the workers, which inherit this patch.
+            return dict((kstock._symbol_key(symbol),
+                         {'last_trade_price': '1.00'})
+                        for symbol in symbol_list)
+
+        saved = kstock.get_all
+        kstock.get_all = get_all
+        self.addCleanup(setattr, kstock, 'get_all', saved)
+        spc.emit_points = points.extend
+        self.assertEqual(spc.main_workers(symbols, 0), 0)
+        # Every symbol is polled once per API, by one of the workers.
+        hosts = sorted(host for host, _, _, _ in points)
+        expected = ['AAPL', 'GOOG', 'IBM', 'INTC', 'IXIC', 'MSFT', 'ORCL']
+        self.assertEqual(hosts, sorted(expected * len(kstock.APIS)))
+
+
+if __name__ == '__main__':
+    unittest.main()